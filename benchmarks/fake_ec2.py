@@ -0,0 +1,103 @@
+"""
+A local stand-in for boto's EC2 connection.
+
+Instances are handed the loopback addresses the fake SSH servers listen on, stay pending
+for a configurable boot time and answer describe calls after a configurable API latency.
+Every call is counted so a benchmark can report how many requests a command made.
+"""
+
+import datetime
+import itertools
+import threading
+import time
+
+class FakeInstance(object):
+    def __init__(self, instance_id, address, zone, instance_type, boot_time):
+        self.id = instance_id
+        self.ip_address = self.private_ip_address = address
+        self.public_dns_name = self.private_dns_name = address
+        self.placement = zone
+        self.instance_type = instance_type
+        self.launch_time = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        self.ready_at = time.time() + boot_time
+        self._state = 'pending'
+
+    @property
+    def state(self):
+        if self._state == 'pending' and time.time() >= self.ready_at:
+            self._state = 'running'
+        return self._state
+
+    def update(self):
+        return self.state
+
+class FakeReservation(object):
+    def __init__(self, instances):
+        self.instances = instances
+
+class FakeEC2(object):
+    """
+    The shared fake cloud. connect_to_region() returns a connection bound to it.
+    """
+    def __init__(self, addresses, boot_time=1.0, api_latency=0.05):
+        self.free_addresses = list(addresses)
+        self.boot_time = boot_time
+        self.api_latency = api_latency
+        self.instances = {}
+        self.calls = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def connect_to_region(self, region, **kwargs):
+        return FakeEC2Connection(self, region)
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        time.sleep(self.api_latency)
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls = {}
+
+class FakeEC2Connection(object):
+    def __init__(self, cloud, region):
+        self.cloud = cloud
+        self.region = region
+
+    def run_instances(self, image_id, min_count, max_count, placement=None, instance_type=None, **kwargs):
+        self.cloud.call('run_instances')
+
+        with self.cloud.lock:
+            instances = []
+            for n in range(max_count):
+                instance = FakeInstance('i-%08x' % next(self.cloud.ids), self.cloud.free_addresses.pop(0),
+                    placement or self.region + 'a', instance_type, self.cloud.boot_time)
+                self.cloud.instances[instance.id] = instance
+                instances.append(instance)
+
+        return FakeReservation(instances)
+
+    def get_all_instances(self, instance_ids=None, filters=None):
+        self.cloud.call('get_all_instances')
+
+        with self.cloud.lock:
+            ids = instance_ids or list(self.cloud.instances)
+            return [FakeReservation([self.cloud.instances[i]]) for i in ids if i in self.cloud.instances]
+
+    def terminate_instances(self, instance_ids):
+        self.cloud.call('terminate_instances')
+
+        with self.cloud.lock:
+            for instance_id in instance_ids:
+                instance = self.cloud.instances.pop(instance_id)
+                self.cloud.free_addresses.append(instance.ip_address)
+
+        return instance_ids
+
+    def create_tags(self, instance_ids, tags):
+        self.cloud.call('create_tags')
+
+    def get_all_security_groups(self, filters=None):
+        self.cloud.call('get_all_security_groups')
+        return []
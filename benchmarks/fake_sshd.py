@@ -0,0 +1,200 @@
+"""
+In-process SSH servers standing in for ants.
+
+Every simulated ant gets its own listener on a distinct loopback address (127.0.x.y) and
+its own scratch directory, which acts as the ant's file system root for SFTP and for any
+absolute /tmp/ path in the commands it runs. Commands themselves run as local processes.
+Only the benchmark's own key is accepted and nothing listens outside the loopback network.
+"""
+
+import base64
+import os
+import selectors
+import socket
+import subprocess
+import threading
+
+import paramiko
+
+def ant_addresses(count):
+    return ['127.0.%i.%i' % (1 + n // 250, 2 + n % 250) for n in range(count)]
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self, ant):
+        self.ant = ant
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        if key == self.ant.authorized_key:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.ant.run, args=(channel, command.decode('utf-8')))
+        thread.daemon = True
+        thread.start()
+        return True
+
+class _Handle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        if attr.st_mode is not None:
+            os.chmod(self.path, attr.st_mode)
+        if attr.st_size is not None:
+            os.ftruncate(self.writefile.fileno(), attr.st_size)
+        return paramiko.SFTP_OK
+
+class _SFTP(paramiko.SFTPServerInterface):
+    def __init__(self, server, *args, **kwargs):
+        self.ant = server.ant
+
+    def open(self, path, flags, attr):
+        local = self.ant.localize(path)
+        try:
+            fd = os.open(local, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'r+b'
+        else:
+            mode = 'rb'
+
+        handle = _Handle(flags)
+        handle.path = local
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.ant.localize(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def chattr(self, path, attr):
+        if attr.st_mode is not None:
+            os.chmod(self.ant.localize(path), attr.st_mode)
+        return paramiko.SFTP_OK
+
+    def remove(self, path):
+        try:
+            os.remove(self.ant.localize(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self.ant.localize(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self.ant.localize(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        os.rename(self.ant.localize(oldpath), self.ant.localize(newpath))
+        return paramiko.SFTP_OK
+
+    posix_rename = rename
+
+    def list_folder(self, path):
+        local = self.ant.localize(path)
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local, name)), name) for name in os.listdir(local)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+class FakeAnt(object):
+    def __init__(self, address, root, authorized_key):
+        self.address = address
+        self.root = root
+        self.authorized_key = authorized_key
+        os.makedirs(os.path.join(root, 'tmp'))
+
+    def localize(self, path):
+        return os.path.join(self.root, path.lstrip('/')) if path.startswith('/') else os.path.join(self.root, path)
+
+    def run(self, channel, command):
+        # Absolute /tmp/ paths (uploaded order files) live in the ant's own directory
+        command = command.replace('/tmp/', os.path.join(self.root, 'tmp') + '/')
+        process = subprocess.Popen(['sh', '-c', command], cwd=self.root,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def feed():
+            try:
+                for data in iter(lambda: channel.recv(32768), b''):
+                    process.stdin.write(data)
+                process.stdin.close()
+            except (IOError, OSError):
+                pass
+
+        def pump(source, send):
+            for data in iter(lambda: source.read1(32768), b''):
+                send(data)
+
+        threads = [threading.Thread(target=pump, args=(process.stdout, channel.sendall)),
+                   threading.Thread(target=pump, args=(process.stderr, channel.sendall_stderr))]
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+
+        for thread in threads + [feeder]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        channel.send_exit_status(process.wait())
+        channel.close()
+
+def serve(count, port, public_key_base64, root, ready=None):
+    """
+    Listen for SSH connections on `count` loopback addresses until the process is killed.
+    """
+    host_key = paramiko.RSAKey.generate(2048)
+    authorized_key = paramiko.RSAKey(data=base64.b64decode(public_key_base64))
+
+    selector = selectors.DefaultSelector()
+
+    for n, address in enumerate(ant_addresses(count)):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((address, port))
+        listener.listen(64)
+        listener.setblocking(False)
+        selector.register(listener, selectors.EVENT_READ, FakeAnt(address, os.path.join(root, 'ant-%i' % n), authorized_key))
+
+    if ready is not None:
+        ready.set()
+
+    while True:
+        for key, events in selector.select():
+            try:
+                sock, address = key.fileobj.accept()
+            except (IOError, OSError):
+                continue
+
+            sock.setblocking(True)
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _SFTP)
+            # With an event the handshake runs on the transport's own thread, so a port
+            # probe that hangs up before the banner does not stall or kill this loop
+            transport.start_server(threading.Event(), server=_Server(key.data))
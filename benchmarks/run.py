@@ -0,0 +1,165 @@
+"""
+Benchmark hivemind against a simulated hive on the local machine.
+
+    python -m benchmarks.run --ants 10,100,1100
+
+boto.ec2.connect_to_region is replaced by a fake EC2 and every ant is a paramiko SSH
+server on its own loopback address, served from a separate process so the controller's
+memory is measured on its own. For each hive size the benchmark runs up, an order and
+an order file fan-out and reports wall time, ants per second, EC2 calls, SSH handshake
+latency, per-ant tail latency, the controller's peak memory and the exit status. Sizes
+above 1024 ants check that nothing depends on descriptor numbers staying below 1024.
+"""
+
+from optparse import OptionParser
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import boto.ec2
+import paramiko
+
+from hivemindsrc import ants
+from . import fake_ec2, fake_sshd
+
+KEY_NAME = 'hivemind-bench'
+
+def _serve(count, port, public_key, root, ready):
+    # The servers are noisy about the port probes from up --wait-ssh
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 2)
+    fake_sshd.serve(count, port, public_key, root, ready)
+
+def _percentile(durations, percent):
+    return ants._percentile(sorted(durations), percent) if durations else 0.0
+
+def _measure(name, count, cloud, function):
+    cloud.reset_calls()
+
+    with open(os.devnull, 'w') as devnull:
+        save_stdout = sys.stdout
+        sys.stdout = devnull
+        started = time.time()
+        status = 0
+        try:
+            function()
+        except SystemExit as e:
+            status = e.code
+        finally:
+            wall = time.time() - started
+            sys.stdout = save_stdout
+
+    spans = list(ants._profile.spans)
+    handshakes = [d for phase, ant, s, d in spans if phase in ('connect', 'auth')]
+
+    per_ant = {}
+    for phase, ant, s, duration in spans:
+        if ant is not None and phase != 'api':
+            per_ant[ant] = per_ant.get(ant, 0) + duration
+    latencies = list(per_ant.values())
+
+    return {
+        'ants': count,
+        'phase': name,
+        'wall': wall,
+        'ants_per_second': count / wall if wall else 0.0,
+        'api_calls': sum(cloud.calls.values()),
+        'handshake_p50': _percentile(handshakes, 50),
+        'handshake_p95': _percentile(handshakes, 95),
+        'handshake_total': sum(handshakes),
+        'latency_p50': _percentile(latencies, 50),
+        'latency_p95': _percentile(latencies, 95),
+        'latency_p99': _percentile(latencies, 99),
+        'latency_max': max(latencies) if latencies else 0.0,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'exit_code': status
+    }
+
+def _print_row(row):
+    print('%6i %-11s %8.2f %8.1f %5i %8.3f %8.3f %8.3f %8.3f %8.3f %8.3f %8.1f %5s' % (
+        row['ants'], row['phase'], row['wall'], row['ants_per_second'], row['api_calls'],
+        row['handshake_p50'], row['handshake_p95'], row['latency_p50'], row['latency_p95'],
+        row['latency_p99'], row['latency_max'], row['peak_rss_mb'], row['exit_code']))
+
+def main():
+    parser = OptionParser(usage="python -m benchmarks.run [options]")
+    parser.add_option('--ants', dest='ants', default='10,100',
+                      help="Comma separated hive sizes to benchmark (default: 10,100).")
+    parser.add_option('--parallel', dest='parallel', type='int', default=ants.DEFAULT_PARALLEL,
+                      help="Passed on to order as --parallel (default: %d)." % ants.DEFAULT_PARALLEL)
+    parser.add_option('--payload-size', dest='payload_size', type='int', default=1024 * 1024,
+                      help="Size in bytes of the order file fanned out to every ant (default: 1 MiB).")
+    parser.add_option('--boot-time', dest='boot_time', type='float', default=1.0,
+                      help="Seconds a fake instance stays pending (default: 1).")
+    parser.add_option('--api-latency', dest='api_latency', type='float', default=0.05,
+                      help="Seconds every fake EC2 call takes (default: 0.05).")
+    parser.add_option('--port', dest='port', type='int', default=2222,
+                      help="The port the fake ants listen on (default: 2222).")
+    parser.add_option('--json', dest='json', default=None,
+                      help="Also write the results to this file as JSON lines.")
+    (options, args) = parser.parse_args()
+
+    sizes = [int(n) for n in options.ants.split(',')]
+
+    # Every ant holds a socket and a pipe or two, so large hives need more than 1024 descriptors
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 65536 if hard == resource.RLIM_INFINITY else hard
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    root = tempfile.mkdtemp(prefix='hivemind-bench-')
+
+    # Keys and the hive state live in a throwaway home directory
+    os.environ['HOME'] = root
+    os.makedirs(os.path.join(root, '.ssh'))
+    key = paramiko.RSAKey.generate(2048)
+    key.write_private_key_file(os.path.join(root, '.ssh', '%s.pem' % KEY_NAME))
+
+    payload = os.path.join(root, 'payload.sh')
+    with open(payload, 'w') as f:
+        f.write('#!/bin/sh\nexit 0\n')
+        f.write('#' * max(0, options.payload_size - 18) + '\n')
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=_serve, args=(max(sizes), options.port, key.get_base64(), os.path.join(root, 'ants'), ready))
+    server.daemon = True
+    server.start()
+    ready.wait()
+
+    cloud = fake_ec2.FakeEC2(fake_sshd.ant_addresses(max(sizes)), options.boot_time, options.api_latency)
+    boto.ec2.connect_to_region = cloud.connect_to_region
+    ants.SSH_PORT = options.port
+    ants.STATE_FILENAME = os.path.join(root, '.ants')
+
+    print('  ants phase           wall   ants/s   api   hs p50   hs p95  ant p50  ant p95  ant p99  ant max  rss MiB  exit')
+
+    rows = []
+    try:
+        for count in sizes:
+            for name, function in [
+                    ('up', lambda: ants.up(count, 'default', 'us-east-1a', 'ami-bench', 't1.micro', 'bench', KEY_NAME, None, wait_ssh=True)),
+                    ('order', lambda: ants.order(['true'], None, options.parallel)),
+                    ('order file', lambda: ants.order(None, [payload], options.parallel))]:
+                row = _measure(name, count, cloud, function)
+                _print_row(row)
+                rows.append(row)
+
+            with open(os.devnull, 'w') as devnull:
+                with ants._redirect_stdout(devnull):
+                    ants.down()
+    finally:
+        server.terminate()
+        shutil.rmtree(root, ignore_errors=True)
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            for row in rows:
+                f.write(json.dumps(row, sort_keys=True) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -24,31 +24,78 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import os
 import re
+import select
 import socket
+import threading
 import time
 import sys
 IS_PY2 = sys.version_info.major == 2
 if IS_PY2:
     from urllib2 import urlopen, Request
     from StringIO import StringIO
+    from pipes import quote
 else:
     from urllib.request import urlopen, Request
     from io import StringIO
+    from shlex import quote
 import base64
 import csv
+import difflib
+import hashlib
+import itertools
+import json
+import math
+import tempfile
 import random
+import shutil
 import ssl
+import tarfile
 from contextlib import contextmanager
 import traceback
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import boto.ec2
 import boto.exception
 import paramiko
 
 STATE_FILENAME = os.path.expanduser('~/.ants')
+STATE_VERSION = 2
+STATE_TTL = 15 * 60
+SSH_PORT = 22
+SSH_PROBE_TIMEOUT = 3
+POLL_MIN_DELAY = 2
+POLL_MAX_DELAY = 15
+EC2_REQUEST_CHUNK = 200
+EC2_PARALLEL = 16
+WARM_STATES = ('stopping', 'stopped')
+AGGREGATE_SPOOL_SIZE = 1024 * 1024
+PROBE_COMMAND = 'nproc; cat /proc/loadavg; grep MemAvailable /proc/meminfo'
+SSH_KEEPALIVE = 30
+DEFAULT_PARALLEL = 64
+KEEP_CONNECTIONS = False
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_RETRIES = 2
+RETRY_DELAY = 1
+HEDGE_MIN_SAMPLES = 5
+WORK_POLL_DELAY = 0.5
+OUTPUT_CHUNK_SIZE = 32768
+MAX_LINE_LENGTH = 65536
+DEFAULT_CHUNK_SIZE = 100
+SFTP_WINDOW_SIZE = 16 * 1024 * 1024
+SFTP_WRITE_SIZE = 32768
+UPLOAD_PATH = '/tmp/'
+RELAY_KEY_PATH = '/tmp/.hivemind-relay-key'
+COLLECT_NO_MATCH = 3
+SYNC_BLOCK_SIZE = 128 * 1024
+SYNC_MANIFEST = '.hivemind-manifest'
+SSH_MAX_SESSIONS = 10
 
 # Utilities
 
@@ -59,29 +106,248 @@ def _redirect_stdout(outfile=None):
     yield
     sys.stdout = save_stdout
 
-def _read_server_list():
-    instance_ids = []
+# Timing
+
+class _Profile(object):
+    """
+    Collect how long each phase of a run took on each ant.
+
+    Phases are EC2 API calls ("api"), opening the TCP connection ("connect"), the SSH
+    handshake and authentication ("auth"), uploads ("upload"), running orders ("exec")
+    and collecting files ("download").
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.spans = []
+
+    def record(self, phase, ant, started):
+        """
+        Record a span that started at `started` and ends now, and return its duration.
+        """
+        duration = time.time() - started
+
+        with self.lock:
+            self.spans.append((phase, ant, started, duration))
+
+        return duration
+
+    @contextmanager
+    def timed(self, phase, ant=None):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.record(phase, ant, started)
+
+    def summary(self):
+        with self.lock:
+            spans = list(self.spans)
+
+        if not spans:
+            return
+
+        print('Phase        count    total      p50      p95      p99      max')
+
+        for phase in ['api', 'connect', 'auth', 'upload', 'exec', 'download']:
+            durations = sorted(duration for name, ant, started, duration in spans if name == phase)
+            if durations:
+                print('%-10s %7i %8.2f %8.3f %8.3f %8.3f %8.3f' % (
+                    phase, len(durations), sum(durations), _percentile(durations, 50),
+                    _percentile(durations, 95), _percentile(durations, 99), durations[-1]))
+
+        per_ant = {}
+        for name, ant, started, duration in spans:
+            if ant is not None:
+                per_ant[ant] = per_ant.get(ant, 0) + duration
+
+        slowest = sorted(per_ant.items(), key=lambda item: item[1], reverse=True)[:5]
+        if slowest:
+            print('Slowest ants: %s' % ', '.join('%s (%.2fs)' % item for item in slowest))
+
+    def write_trace(self, path):
+        """
+        Write the spans as a Chrome trace (chrome://tracing or Perfetto), one row per ant.
+        """
+        with self.lock:
+            spans = list(self.spans)
+
+        events = [{
+            'name': phase,
+            'ph': 'X',
+            'pid': 1,
+            'tid': ant or 'controller',
+            'ts': int((started - self.started) * 1000000),
+            'dur': int(duration * 1000000)
+        } for phase, ant, started, duration in spans]
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events}, f)
+
+def _percentile(ordered, percent):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100.0))]
+
+_profile = _Profile()
+
+@contextmanager
+def _state_lock():
+    # Serialize read-modify-write cycles on the state file between concurrent hivemind runs
+    if fcntl is None:
+        yield
+        return
+
+    with open(STATE_FILENAME + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _load_state():
+    """
+    Load the hive state file, or return None if there is no hive.
 
+    State files written by older versions (username, key, zone and bare instance ids, one
+    per line) are read as a state whose cached instance details are already stale.
+    """
     if not os.path.isfile(STATE_FILENAME):
-        return (None, None, None, None)
+        return None
 
     with open(STATE_FILENAME, 'r') as f:
-        username = f.readline().strip()
-        key_name = f.readline().strip()
-        zone = f.readline().strip()
         text = f.read()
-        instance_ids = [i for i in text.split('\n') if i != '']
 
-        print('Read %i bees from the roster.' % len(instance_ids))
+    try:
+        state = json.loads(text)
+    except ValueError:
+        lines = text.split('\n')
+        state = {
+            'version': STATE_VERSION,
+            'username': lines[0].strip(),
+            'key_name': lines[1].strip(),
+            'zone': lines[2].strip(),
+            'updated': 0,
+            'instances': [{'id': i.strip()} for i in lines[3:] if i.strip() != '']
+        }
+
+    return state
+
+def _save_state(state):
+    state['version'] = STATE_VERSION
+
+    # Write to a temporary file next to the state file and rename it over, so readers
+    # never see a half written state
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(STATE_FILENAME), prefix='.ants.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        if hasattr(os, 'replace'):
+            os.replace(temp_path, STATE_FILENAME)
+        else:
+            os.rename(temp_path, STATE_FILENAME)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+def _state_is_fresh(state):
+    # Stopped ants have no address until they are started again
+    return time.time() - state.get('updated', 0) < STATE_TTL and all(
+        _instance_address(r) for r in state['instances'] if r.get('state') not in WARM_STATES)
+
+def _instance_record(instance):
+    return {
+        'id': instance.id,
+        'zone': instance.placement,
+        'state': instance.state,
+        'instance_type': instance.instance_type,
+        'launch_time': instance.launch_time,
+        'public_dns_name': instance.public_dns_name,
+        'private_dns_name': instance.private_dns_name,
+        'ip_address': instance.ip_address,
+        'private_ip_address': instance.private_ip_address,
+        'seen': time.time()
+    }
+
+def _instance_address(record):
+    return record.get('public_dns_name') or record.get('private_dns_name')
+
+def _read_server_list():
+    state = _load_state()
+
+    if state is None:
+        return (None, None, None, None)
+
+    instance_ids = [r['id'] for r in state['instances']]
+
+    print('Read %i bees from the roster.' % len(instance_ids))
+
+    return (state['username'], state['key_name'], state['zone'], instance_ids)
+
+def _write_server_list(username, key_name, zone, instances, launch=None):
+    state = {
+        'username': username,
+        'key_name': key_name,
+        'zone': zone,
+        'updated': time.time(),
+        'instances': [_instance_record(instance) for instance in instances]
+    }
+
+    # How the hive was called up, so scale can launch more of the same
+    if launch:
+        state['launch'] = launch
+
+    with _state_lock():
+        _save_state(state)
+
+def _update_server_list(instances):
+    """
+    Refresh the cached details of the given instances in the state file.
+    """
+    records = dict((instance.id, _instance_record(instance)) for instance in instances)
+
+    with _state_lock():
+        state = _load_state()
+        if state is None:
+            return
+
+        # Merged so that fields only some commands fill in, such as probes, survive
+        state['instances'] = [dict(r, **records[r['id']]) if r['id'] in records else r for r in state['instances']]
+        if set(r['id'] for r in state['instances']) <= set(records):
+            state['updated'] = time.time()
+
+        _save_state(state)
+
+def _add_to_server_list(instances):
+    """
+    Add the given instances to the state file, refreshing any it already has.
+    """
+    records = dict((instance.id, _instance_record(instance)) for instance in instances)
+
+    with _state_lock():
+        state = _load_state()
+        if state is None:
+            return
+
+        known = set(r['id'] for r in state['instances'])
+        state['instances'] = [dict(r, **records[r['id']]) if r['id'] in records else r for r in state['instances']]
+        state['instances'].extend(_instance_record(instance) for instance in instances if instance.id not in known)
+
+        _save_state(state)
+
+def _remove_from_server_list(instance_ids):
+    instance_ids = set(instance_ids)
+
+    with _state_lock():
+        state = _load_state()
+        if state is None:
+            return
 
-    return (username, key_name, zone, instance_ids)
+        state['instances'] = [r for r in state['instances'] if r['id'] not in instance_ids]
 
-def _write_server_list(username, key_name, zone, instances):
-    with open(STATE_FILENAME, 'w') as f:
-        f.write('%s\n' % username)
-        f.write('%s\n' % key_name)
-        f.write('%s\n' % zone)
-        f.write('\n'.join([instance.id for instance in instances]))
+        _save_state(state)
 
 def _delete_server_list():
     os.remove(STATE_FILENAME)
@@ -92,6 +358,112 @@ def _get_pem_path(key):
 def _get_region(zone):
     return zone if 'gov' in zone else zone[:-1] # chop off the "d" in the "us-east-1d" to get the "Region"
 
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+_ec2_connections = {}
+_ec2_connections_lock = threading.Lock()
+
+def _get_ec2_connection(region):
+    """
+    Return the EC2 connection for a region, made once and shared by every thread.
+    """
+    with _ec2_connections_lock:
+        if region not in _ec2_connections:
+            with _profile.timed('api'):
+                connection = boto.ec2.connect_to_region(region)
+
+            if connection == None:
+                raise Exception("Invalid zone specified? Unable to connect to region %s" % region)
+
+            _ec2_connections[region] = connection
+
+        return _ec2_connections[region]
+
+def _parse_zones(zones, count):
+    """
+    Parse a zone list such as "us-east-1a:10,eu-west-1b:20" into (zone, count) pairs.
+
+    Zones given without a count share the remaining servers evenly.
+    """
+    specs = [z.strip().split(':') for z in zones.split(',') if z.strip()]
+    counted = [(spec[0], int(spec[1])) for spec in specs if len(spec) > 1]
+    uncounted = [spec[0] for spec in specs if len(spec) == 1]
+
+    remaining = max(0, count - sum(n for z, n in counted)) if uncounted else 0
+    for i, zone in enumerate(uncounted):
+        counted.append((zone, remaining // len(uncounted) + (1 if i < remaining % len(uncounted) else 0)))
+
+    return [(zone, n) for zone, n in counted]
+
+def _parse_images(image_id):
+    """
+    Parse an AMI, or a list of AMIs by region such as "us-east-1=ami-a,eu-west-1=ami-b",
+    into a dict of region to AMI. A single AMI is keyed by None.
+    """
+    if '=' not in image_id:
+        return {None: image_id.strip()}
+
+    return dict((region.strip(), ami.strip()) for region, ami in (i.split('=', 1) for i in image_id.split(',') if i.strip()))
+
+def _image_for_zone(image_id, zone):
+    images = _parse_images(image_id)
+    return images.get(None) or images.get(_get_region(zone))
+
+def _for_each_region(function, zones_and_ids):
+    """
+    Group instance ids by region and call function(region, ids) for every region at once.
+
+    Each region's ids are split into chunks of at most EC2_REQUEST_CHUNK, which are
+    called concurrently too, up to EC2_PARALLEL calls at a time. Returns the
+    concatenated lists the calls return.
+    """
+    groups = {}
+    for zone, instance_id in zones_and_ids:
+        groups.setdefault(_get_region(zone), []).append(instance_id)
+
+    calls = [(region, chunk) for region, ids in groups.items() for chunk in _chunks(ids, EC2_REQUEST_CHUNK)]
+
+    if not calls:
+        return []
+
+    pool = ThreadPool(min(len(calls), EC2_PARALLEL))
+    try:
+        results = pool.map(lambda item: function(*item), calls)
+    finally:
+        pool.close()
+        pool.join()
+
+    return [item for result in results for item in result]
+
+def _describe_hive(state):
+    records = [(r.get('zone') or state['zone'], r['id']) for r in state['instances']]
+
+    return _for_each_region(lambda region, ids: _describe_instances(_get_ec2_connection(region), ids), records)
+
+def _describe_instances(connection, instance_ids, missing_ok=False):
+    """
+    Describe instances in chunks of at most EC2_REQUEST_CHUNK ids.
+
+    With missing_ok a chunk that names an instance EC2 does not know yet is skipped,
+    as freshly launched instances can take a moment to become visible.
+    """
+    instances = []
+
+    for chunk in _chunks(instance_ids, EC2_REQUEST_CHUNK):
+        try:
+            with _profile.timed('api'):
+                reservations = connection.get_all_instances(instance_ids=chunk)
+        except boto.exception.EC2ResponseError as e:
+            if not missing_ok or e.error_code != 'InvalidInstanceID.NotFound':
+                raise
+            reservations = []
+
+        for reservation in reservations:
+            instances.extend(reservation.instances)
+
+    return instances
+
 def _get_security_group_id(connection, security_group_name, subnet):
     if not security_group_name:
         print('The bees need a security group to run under. Need to open a port from where you are to the target subnet.')
@@ -109,36 +481,82 @@ def _get_security_group_id(connection, security_group_name, subnet):
 
 # Methods
 
-def up(count, group, zone, image_id, instance_type, username, key_name, subnet, bid = None):
+def up(count, group, zone, image_id, instance_type, username, key_name, subnet, bid = None, wait_ssh = False, min_fulfilled = None, spot_timeout = None, profile_path = None):
     """
     Startup the load testing server.
-    """
 
-    existing_username, existing_key_name, existing_zone, instance_ids = _read_server_list()
+    The zone can list several zones, in any number of regions, each with its own count
+    (for example "us-east-1a:10,eu-west-1b:20"). Every zone is launched at the same time.
+    Zones in several regions need an AMI for each region (for example
+    "us-east-1=ami-a,eu-west-1=ami-b").
+    """
+    _profile.reset()
 
     count = int(count)
-    if existing_username == username and existing_key_name == key_name and existing_zone == zone:
-        ec2_connection = boto.ec2.connect_to_region(_get_region(zone))
-        existing_reservations = ec2_connection.get_all_instances(instance_ids=instance_ids)
-        existing_instances = filter(lambda i: i.state == 'running', [r.instances[0] for r in existing_reservations])
-        
-        # User, key and zone match existing values and instance ids are found on state file
-        if count <= len(existing_instances):
-            # Count is less than the amount of existing instances. No need to create new ones.
-            print('Ants are already assembled and awaiting orders.')
-            return
+    zones = _parse_zones(zone, count)
+
+    # AMIs only exist in the region they were registered in
+    regions = sorted(set(_get_region(launch_zone) for launch_zone, zone_count in zones))
+    images = _parse_images(image_id)
+    if None in images and len(regions) > 1:
+        print('An AMI only exists in one region. Give one for each of %s, e.g. -i us-east-1=ami-a,eu-west-1=ami-b.' % ', '.join(regions))
+        return
+    missing = [r for r in regions if None not in images and r not in images]
+    if missing:
+        print('No AMI was given for %s.' % ', '.join(missing))
+        return
+
+    state = _load_state()
+    existing_instances = []
+    warm_instances = []
+
+    if state and state['instances']:
+        if state['username'] == username and state['key_name'] == key_name:
+            # User and key match the existing hive, so only the missing ants need to be called up
+            print('Read %i bees from the roster.' % len(state['instances']))
+            described = _describe_hive(state)
+            existing_instances = [i for i in described if i.state == 'running']
+            warm_instances = [i for i in described if i.state in WARM_STATES]
         else:
-            # Count is greater than the amount of existing instances. Need to create the only the extra instances.
-            count -= len(existing_instances)
-    elif instance_ids:
-        # Instances found on state file but user, key and/or zone not matching existing value.
-        # State file only stores one user/key/zone config combination so instances are unusable.
-        print('Taking down {} unusable ants.'.format(len(instance_ids)))
-        # Redirect prints in down() to devnull to avoid duplicate messages
-        with _redirect_stdout():
-            down()
-        # down() deletes existing state file so _read_server_list() returns a blank state
-        existing_username, existing_key_name, existing_zone, instance_ids = _read_server_list()
+            # State file only stores one user/key config combination so instances are unusable.
+            print('Taking down {} unusable ants.'.format(len(state['instances'])))
+            # Redirect prints in down() to devnull to avoid duplicate messages
+            with _redirect_stdout():
+                down()
+
+    launches = []
+    for launch_zone, zone_count in zones:
+        existing_count = len([i for i in existing_instances if i.placement == launch_zone])
+        if zone_count > existing_count:
+            # Stopped ants from down --keep-warm are started before any new ones are launched
+            starts = [i.id for i in warm_instances if i.placement == launch_zone][:zone_count - existing_count]
+            launches.append({
+                'zone': launch_zone,
+                'count': zone_count - existing_count - len(starts),
+                'start': starts,
+                'group': group,
+                'image_id': image_id,
+                'instance_type': instance_type,
+                'key_name': key_name,
+                'subnet': subnet,
+                'bid': bid,
+                'wait_ssh': wait_ssh,
+                'min_fulfilled': min_fulfilled,
+                'spot_timeout': spot_timeout
+            })
+
+    if not launches:
+        # Every zone already has at least as many ants as requested. No need to create new ones.
+        print('Ants are already assembled and awaiting orders.')
+        return
+
+    if min_fulfilled is not None:
+        # min_fulfilled counts the whole hive, so only the spot ants still missing are waited
+        # for, shared out over the zones in proportion to what each one requests
+        wanted = max(0, min_fulfilled - len(existing_instances) - sum(len(launch['start']) for launch in launches))
+        shares = _split_count([(launch['zone'], launch['count']) for launch in launches], wanted)
+        for launch, (launch_zone, share) in zip(launches, shares):
+            launch['min_fulfilled'] = min(share, launch['count'])
 
     pem_path = _get_pem_path(key_name)
 
@@ -148,301 +566,2106 @@ def up(count, group, zone, image_id, instance_type, username, key_name, subnet,
     print('Connecting to the hive.')
 
     try:
-        ec2_connection = boto.ec2.connect_to_region(_get_region(zone))
+        for launch in launches:
+            _get_ec2_connection(_get_region(launch['zone']))
     except boto.exception.NoAuthHandlerFound as e:
         print("Authenciation config error, perhaps you do not have a ~/.boto file with correct permissions?")
-        print(e.message)
-        return e
-    except Exception as e:
-        print("Unknown error occured:")
-        print(e.message)
+        print(e)
         return e
 
-    if ec2_connection == None:
-        raise Exception("Invalid zone specified? Unable to connect to region using zone name")
+    # Written before launching so each zone can add its ants as they are called up, and
+    # none are lost from the roster if another zone fails. Warm ants that are not needed
+    # stay on it, still stopped.
+    _write_server_list(username, key_name, zones[0][0], existing_instances + warm_instances, {
+        'zones': zones,
+        'group': group,
+        'image_id': image_id,
+        'instance_type': instance_type,
+        'subnet': subnet,
+        'bid': bid
+    })
+
+    pool = ThreadPool(len(launches))
+    try:
+        launched = pool.map(_launch_zone, launches)
+    finally:
+        pool.close()
+        pool.join()
+
+    instances = existing_instances + [instance for zone_instances in launched for instance in zone_instances]
 
-    groupId = group if subnet is None else _get_security_group_id(ec2_connection, group, subnet)
-    print("GroupId found: %s" % groupId)
+    print('The hive has assembled %i ants.' % len(instances))
+
+    _profile.summary()
+    if profile_path:
+        _profile.write_trace(profile_path)
+
+def _launch_zone(params):
+    """
+    Call up ants in one zone and wait for them to be ready.
+
+    The ants are added to the roster as soon as they are called up, and again once
+    they are ready. Returns the ready instances.
+    """
+    zone = params['zone']
+    count = params['count']
+    ec2_connection = _get_ec2_connection(_get_region(zone))
+
+    groupId = params['group'] if params['subnet'] is None else _get_security_group_id(ec2_connection, params['group'], params['subnet'])
+    _log("GroupId found: %s" % groupId)
 
     placement = None if 'gov' in zone else zone
-    print("Placement: %s" % placement)
+    _log("Placement: %s" % placement)
+
+    instances = []
 
+    if params.get('start'):
+        instances = _start_instances(ec2_connection, params['start'], zone)
 
-    if bid:
-        print('Attempting to call up %i spot ants, this can take a while...' % count)
+        # Warm ants that could not be started are replaced by new ones
+        count += len(params['start']) - len(instances)
 
-        spot_requests = ec2_connection.request_spot_instances(
-            image_id=image_id,
-            price=bid,
-            count=count,
-            key_name=key_name,
-            security_group_ids=[groupId],
-            instance_type=instance_type,
-            placement=placement,
-            subnet_id=subnet)
+    try:
+        if count and params['bid']:
+            _log('Attempting to call up %i spot ants in %s, this can take a while...' % (count, zone))
+
+            with _profile.timed('api'):
+                spot_requests = ec2_connection.request_spot_instances(
+                    image_id=_image_for_zone(params['image_id'], zone),
+                    price=params['bid'],
+                    count=count,
+                    key_name=params['key_name'],
+                    security_group_ids=[groupId],
+                    instance_type=params['instance_type'],
+                    placement=placement,
+                    subnet_id=params['subnet'])
+
+            # it can take a few seconds before the spot requests are fully processed
+            time.sleep(5)
 
-        # it can take a few seconds before the spot requests are fully processed
-        time.sleep(5)
+            instances = instances + _wait_for_spot_request_fulfillment(ec2_connection, spot_requests, params['min_fulfilled'], params['spot_timeout'])
+        elif count:
+            _log('Attempting to call up %i ants in %s.' % (count, zone))
 
-        instances = _wait_for_spot_request_fulfillment(ec2_connection, spot_requests)
-    else:
-        print('Attempting to call up %i ants.' % count)
+            with _profile.timed('api'):
+                reservation = ec2_connection.run_instances(
+                    image_id=_image_for_zone(params['image_id'], zone),
+                    min_count=count,
+                    max_count=count,
+                    key_name=params['key_name'],
+                    security_group_ids=[groupId],
+                    instance_type=params['instance_type'],
+                    placement=placement,
+                    subnet_id=params['subnet'])
+
+            instances = instances + reservation.instances
+    except boto.exception.EC2ResponseError as e:
+        _log("Unable to call ants in %s: %s" % (zone, e.message))
+
+    if not instances:
+        return []
+
+    _add_to_server_list(instances)
+
+    _log('Waiting for ants to spawn in %s...' % zone)
+
+    instances = _wait_for_instances(ec2_connection, instances, params['wait_ssh'])
+    _add_to_server_list(instances)
+
+    with _profile.timed('api'):
+        ec2_connection.create_tags([instance.id for instance in instances], { "Name": "an ant!" })
+
+    return instances
+
+def _start_instances(conn, instance_ids, zone):
+    """
+    Start ants that down --keep-warm stopped, after waiting for any still stopping.
+
+    Returns the instances that were started. Chunks EC2 refuses to start, for example
+    for lack of capacity, are logged and left stopped.
+    """
+    delay = POLL_MIN_DELAY
+
+    while True:
+        instances = _describe_instances(conn, instance_ids)
+        stopping = [i for i in instances if i.state == 'stopping']
+        if not stopping:
+            break
 
+        _log('Waiting for %i ants to finish stopping.' % len(stopping))
+        time.sleep(delay)
+        delay = min(delay * 2, POLL_MAX_DELAY)
+
+    instances = [i for i in instances if i.state == 'stopped']
+    _log('Waking up %i ants.' % len(instances))
+
+    started = set()
+    for chunk in _chunks([i.id for i in instances], EC2_REQUEST_CHUNK):
         try:
-            reservation = ec2_connection.run_instances(
-                image_id=image_id,
-                min_count=count,
-                max_count=count,
-                key_name=key_name,
-                security_group_ids=[groupId],
-                instance_type=instance_type,
-                placement=placement,
-                subnet_id=subnet)
+            with _profile.timed('api'):
+                conn.start_instances(instance_ids=chunk)
         except boto.exception.EC2ResponseError as e:
-            print("Unable to call ants:", e.message)
-            return e
+            _log("Unable to wake %i ants in %s: %s" % (len(chunk), zone, e.message))
+            continue
 
-        instances = reservation.instances
+        started.update(chunk)
 
-    if instance_ids:
-        existing_reservations = ec2_connection.get_all_instances(instance_ids=instance_ids)
-        existing_instances = filter(lambda i: i.state == 'running', [r.instances[0] for r in existing_reservations])
-        map(instances.append, existing_instances)
-        dead_instances = filter(lambda i: i not in [j.id for j in existing_instances], instance_ids)
-        map(instance_ids.pop, [instance_ids.index(i) for i in dead_instances])
+    return [i for i in instances if i.id in started]
 
-    print('Waiting for ants to spawn...')
+def _split_count(zones, count):
+    """
+    Share count out over the zones in proportion to their counts, largest remainders first.
+    """
+    total = sum(n for zone, n in zones)
+    weights = [n if total else 1 for zone, n in zones]
+    total = sum(weights)
+
+    shares = [count * weight // total for weight in weights]
+    by_remainder = sorted(range(len(zones)), key=lambda n: count * weights[n] % total, reverse=True)
+    for n in by_remainder[:count - sum(shares)]:
+        shares[n] += 1
+
+    return [(zone, share) for (zone, n), share in zip(zones, shares)]
+
+def _scale_chunk(params):
+    if 'terminate' in params:
+        _terminate_instances(_get_region(params['zone']), params['terminate'])
+        _remove_from_server_list(params['terminate'])
+        _log('Stood down %i ants in %s.' % (len(params['terminate']), params['zone']))
+    else:
+        _launch_zone(params)
 
-    instance_ids = instance_ids or []
+def scale(count, wait_ssh=False, profile_path=None):
+    """
+    Grow or shrink a running hive to count ants.
 
-    for instance in [i for i in instances if i.state == 'pending']:
-        instance.update()
-        while instance.state != 'running':
-            print('.')
-            time.sleep(5)
-            instance.update()
+    Only the difference is launched or terminated, shared out over the zones the hive was
+    called up in. Launches and terminations go out in chunks of at most EC2_REQUEST_CHUNK
+    instances, all at the same time, and the roster is updated as each chunk completes.
+    """
+    _profile.reset()
 
-        instance_ids.append(instance.id)
+    state = _load_state()
 
-        print('Ant %s is ready.' % instance.id)
+    if state is None or 'launch' not in state:
+        print('No hive to scale. Call one up first.')
+        return
 
-    ec2_connection.create_tags(instance_ids, { "Name": "an ant!" })
+    launch = state['launch']
 
-    _write_server_list(username, key_name, zone, instances)
+    print('Read %i bees from the roster.' % len(state['instances']))
+    print('Connecting to the hive.')
 
-    print('The hive has assembled %i ants.' % len(instances))
+    described = _describe_hive(state)
+    instances = [i for i in described if i.state in ('pending', 'running')]
+    warm_instances = [i for i in described if i.state in WARM_STATES]
+
+    # Ants that are gone or going are dropped from the roster
+    live = set(i.id for i in instances + warm_instances)
+    _remove_from_server_list([r['id'] for r in state['instances'] if r['id'] not in live])
+    _update_server_list(described)
+
+    launch_params = {
+        'group': launch['group'],
+        'image_id': launch['image_id'],
+        'instance_type': launch['instance_type'],
+        'key_name': state['key_name'],
+        'subnet': launch['subnet'],
+        'bid': launch['bid'],
+        'wait_ssh': wait_ssh,
+        'min_fulfilled': None,
+        'spot_timeout': None
+    }
+
+    chunks = []
+    for zone, target in _split_count(launch['zones'], int(count)):
+        zone_instances = [i for i in instances if i.placement == zone]
+
+        if target > len(zone_instances):
+            # Stopped ants are started before any new ones are launched
+            starts = [i.id for i in warm_instances if i.placement == zone][:target - len(zone_instances)]
+            missing = target - len(zone_instances) - len(starts)
+            for chunk in _chunks(starts, EC2_REQUEST_CHUNK):
+                chunks.append(dict(launch_params, zone=zone, count=0, start=chunk))
+            for offset in range(0, missing, EC2_REQUEST_CHUNK):
+                chunks.append(dict(launch_params, zone=zone, count=min(EC2_REQUEST_CHUNK, missing - offset)))
+        elif target < len(zone_instances):
+            # Ants that are still starting go first, then the newest
+            newest = sorted(zone_instances, key=lambda i: i.launch_time, reverse=True)
+            surplus = sorted(newest, key=lambda i: i.state == 'running')[:len(zone_instances) - target]
+            for chunk in _chunks([i.id for i in surplus], EC2_REQUEST_CHUNK):
+                chunks.append({'zone': zone, 'terminate': chunk})
+
+    if not chunks:
+        print('The hive already has %i ants.' % len(instances))
+        return
+
+    print('Calling up %i ants and standing down %i.' % (
+        sum(chunk.get('count', 0) + len(chunk.get('start', [])) for chunk in chunks),
+        sum(len(chunk.get('terminate', [])) for chunk in chunks)))
+
+    pool = ThreadPool(min(len(chunks), EC2_PARALLEL))
+    try:
+        pool.map(_scale_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    state = _load_state()
+    print('The hive now has %i ants.' % len([r for r in state['instances'] if r.get('state') not in WARM_STATES]))
 
-def report():
+    _profile.summary()
+    if profile_path:
+        _profile.write_trace(profile_path)
+
+def report(probe=False, parallel=DEFAULT_PARALLEL, connect_timeout=DEFAULT_CONNECT_TIMEOUT, retries=DEFAULT_RETRIES):
     """
     Report the status of the load testing servers.
+
+    With probe, every running ant is also measured over SSH and the results are kept
+    on the roster for order to plan with.
     """
-    username, key_name, zone, instance_ids = _read_server_list()
+    state = _load_state()
 
-    if not instance_ids:
+    if state is None or not state['instances']:
         print('No ants have been mobilized.')
         return
 
-    ec2_connection = boto.ec2.connect_to_region(_get_region(zone))
+    print('Read %i bees from the roster.' % len(state['instances']))
 
-    reservations = ec2_connection.get_all_instances(instance_ids=instance_ids)
+    instances = _describe_hive(state)
 
-    instances = []
+    _update_server_list(instances)
+
+    probes = {}
+    if probe:
+        # The roster was just refreshed, so this reads it without describing the hive again
+        with _redirect_stdout():
+            ants = _assemble_ants(connect_timeout=connect_timeout, retries=retries)
+
+        if ants:
+            print('Probing %i ants.' % len(ants))
 
-    for reservation in reservations:
-        instances.extend(reservation.instances)
+            pool = ThreadPool(max(1, min(int(parallel), len(ants))))
+            try:
+                probes = dict(zip([ant['instance_id'] for ant in ants], pool.map(_probe_ant, ants)))
+            finally:
+                pool.close()
+                pool.join()
+                if not KEEP_CONNECTIONS:
+                    _close_connections()
+
+            _save_probes(probes)
 
     for instance in instances:
-        print('Ant %s: %s @ %s' % (instance.id, instance.state, instance.ip_address))
+        print('Ant %s: %s @ %s (%s)%s' % (instance.id, instance.state, instance.ip_address, instance.placement,
+            _describe_probe(probes[instance.id]) if instance.id in probes else ''))
+
+def _probe_ant(params):
+    """
+    Measure an ant's cores, load average, available memory and SSH round trip time.
+
+    The round trip is a single global request on the pooled transport. A probe of an
+    ant that could not be reached holds the error instead.
+    """
+    probe = {'time': time.time()}
+
+    try:
+        client = _get_connection(params)
+
+        started = time.time()
+        client.get_transport().global_request('keepalive@hivemind', wait=True)
+        probe['rtt'] = time.time() - started
+
+        status, output = _check_output(client, PROBE_COMMAND)
+        lines = output.split('\n')
+        probe['cores'] = int(lines[0])
+        probe['load'] = float(lines[1].split()[0])
+        probe['mem_available'] = int(lines[2].split()[1]) * 1024
+    except (IOError, EOFError, paramiko.SSHException) as e:
+        probe['error'] = _error_text(e)
+    except (ValueError, IndexError):
+        probe['error'] = 'unexpected probe output'
+
+    return probe
+
+def _describe_probe(probe):
+    if 'error' in probe:
+        return ' unreachable: %s' % probe['error']
+
+    return ' %i cores, load %.2f, %i MiB available, %.0f ms' % (
+        probe['cores'], probe['load'], probe['mem_available'] // (1024 * 1024), probe['rtt'] * 1000)
+
+def _save_probes(probes):
+    with _state_lock():
+        state = _load_state()
+        if state is None:
+            return
+
+        for record in state['instances']:
+            if record['id'] in probes:
+                record['probe'] = probes[record['id']]
+
+        _save_state(state)
 
-def down():
+def _probe_is_fresh(probe):
+    return probe is not None and time.time() - probe['time'] < STATE_TTL
+
+def _free_cores(probe):
+    """
+    Return the cores an ant has to spare at its last probe, at least one.
+    """
+    return max(1, int(round(probe['cores'] - probe['load'])))
+
+def _terminate_instances(region, instance_ids):
+    with _profile.timed('api'):
+        return _get_ec2_connection(region).terminate_instances(instance_ids=instance_ids)
+
+def _stop_instances(region, instance_ids):
+    with _profile.timed('api'):
+        _get_ec2_connection(region).stop_instances(instance_ids=instance_ids)
+    return instance_ids
+
+def down(keep_warm=False):
     """
     Shutdown the load testing server.
+
+    With keep_warm the ants are stopped instead and stay on the roster, so the next up
+    can start them again rather than launch new ones.
     """
-    username, key_name, zone, instance_ids = _read_server_list()
+    state = _load_state()
 
-    if not instance_ids:
+    if state is None or not state['instances']:
         print('No ants have been mobilized.')
         return
 
+    print('Read %i bees from the roster.' % len(state['instances']))
+
     print('Connecting to the hive.')
 
-    ec2_connection = boto.ec2.connect_to_region(_get_region(zone))
+    if keep_warm and (state.get('launch') or {}).get('bid'):
+        # One-time spot instances can only be terminated
+        print('Spot ants cannot be kept warm.')
+        keep_warm = False
 
+    if keep_warm:
+        print('Putting the hive to sleep.')
+
+        stopped_instance_ids = set(_for_each_region(_stop_instances,
+            [(r.get('zone') or state['zone'], r['id']) for r in state['instances'] if r.get('state') != 'stopped']))
+
+        # Addresses are kept for reference, but the ants have none until they are started
+        with _state_lock():
+            state = _load_state()
+            for record in state['instances']:
+                if record['id'] in stopped_instance_ids:
+                    record['state'] = 'stopping'
+            _save_state(state)
+
+        print('Stopped %i ants. Call up the hive again to wake them.' % len(stopped_instance_ids))
+
+        _close_connections()
+        return
     print('Calling off the hive.')
 
-    terminated_instance_ids = ec2_connection.terminate_instances(
-        instance_ids=instance_ids)
+    terminated_instance_ids = _for_each_region(_terminate_instances,
+        [(r.get('zone') or state['zone'], r['id']) for r in state['instances']])
 
     print('Stood down %i ants.' % len(terminated_instance_ids))
 
     _delete_server_list()
+    _close_connections()
+
+def _ssh_reachable(instance):
+    address = instance.ip_address or instance.private_ip_address
+
+    try:
+        sock = socket.create_connection((address, SSH_PORT), SSH_PROBE_TIMEOUT)
+    except (socket.error, socket.timeout):
+        return False
 
-def _wait_for_spot_request_fulfillment(conn, requests, fulfilled_requests = []):
+    sock.close()
+    return True
+
+def _wait_for_instances(conn, instances, wait_ssh=False):
     """
-    Wait until all spot requests are fulfilled.
+    Wait until every instance is running, and optionally accepting SSH connections.
+
+    The whole pending set is described on every poll, in chunks of at most
+    EC2_REQUEST_CHUNK ids. Polling backs off while nothing changes and speeds up again as
+    soon as ants come up.
 
-    Once all spot requests are fulfilled, return a list of corresponding spot instances.
+    Returns the refreshed instances in their original order.
     """
-    if len(requests) == 0:
-        reservations = conn.get_all_instances(instance_ids = [r.instance_id for r in fulfilled_requests])
-        return [r.instances[0] for r in reservations]
-    else:
-        time.sleep(10)
-        print('.')
+    running = dict((i.id, i) for i in instances if i.state == 'running')
+    ready = {}
+    delay = POLL_MIN_DELAY
+    pool = ThreadPool(DEFAULT_PARALLEL) if wait_ssh else None
 
-    requests = conn.get_all_spot_instance_requests(request_ids=[req.id for req in requests])
-    for req in requests:
-        if req.status.code == 'fulfilled':
-            fulfilled_requests.append(req)
-            print("spot ant `{}` joined the hive.".format(req.instance_id))
+    try:
+        while len(ready) < len(instances):
+            progress = (len(running), len(ready))
+            pending_ids = [i.id for i in instances if i.id not in running]
 
-    return _wait_for_spot_request_fulfillment(conn, [r for r in requests if r not in fulfilled_requests], fulfilled_requests)
+            for instance in _describe_instances(conn, pending_ids, missing_ok=True):
+                if instance.state == 'running':
+                    running[instance.id] = instance
 
-def _execute_order(params):
-    print('Ant %i is joining the hive.' % params['i'])
+            candidates = [i for i in running.values() if i.id not in ready]
+            reachable = pool.map(_ssh_reachable, candidates) if pool else [True] * len(candidates)
 
-    try:
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            for instance, ok in zip(candidates, reachable):
+                if ok:
+                    ready[instance.id] = instance
+                    _log('Ant %s is ready.' % instance.id)
 
-        pem_path = params.get('key_name') and _get_pem_path(params['key_name']) or None
-        if not os.path.isfile(pem_path):
-            client.load_system_host_keys()
-            client.connect(params['instance_name'], username=params['username'])
-        else:
-            client.connect(
-                params['instance_name'],
-                username=params['username'],
-                key_filename=pem_path)
+            if len(ready) == len(instances):
+                break
 
-        print('Ant %i is executing order' % params['i'])
+            if (len(running), len(ready)) != progress:
+                delay = POLL_MIN_DELAY
+            else:
+                delay = min(delay * 2, POLL_MAX_DELAY)
 
-        stdin, stdout, stderr = client.exec_command(params['order'])
+            _log('Waiting on %i ants.' % (len(instances) - len(ready)))
+            time.sleep(delay)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
-        #response = {}
+    return [ready[i.id] for i in instances]
 
-        # paramiko's read() returns bytes which need to be converted back to a str
-        #ab_results = IS_PY2 and stdout.read() or stdout.read().decode('utf-8')
-        print(stdout.read().decode('utf-8'))
+def _wait_for_spot_request_fulfillment(conn, requests, min_fulfilled=None, timeout=None):
+    """
+    Wait for spot requests to be fulfilled.
 
-        client.close()
+    Without limits this waits for every request. With min_fulfilled it returns as soon as
+    that many ants have arrived. With timeout it returns once the time is up, with whatever
+    has arrived, even if that is fewer than min_fulfilled. Requests still open at that point
+    are cancelled.
 
-    except socket.error as e:
-        return e
-    except Exception as e:
-        traceback.print_exc()
-        print()
-        raise e
+    Returns a list of the fulfilled spot instances.
+    """
+    pending_ids = [req.id for req in requests]
+    instance_ids = []
 
-def _execute_order_file(params):
-    upload_path = "/tmp/"
-    print('Ant %i is joining the hive.' % params['i'])
+    if min_fulfilled is None:
+        min_fulfilled = len(pending_ids)
 
-    try:
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    deadline = time.time() + timeout if timeout else None
+    delay = POLL_MIN_DELAY
+
+    while pending_ids and len(instance_ids) < min_fulfilled:
+        if deadline is not None and time.time() >= deadline:
+            _log('Gave up waiting for spot ants after %is.' % timeout)
+            break
+
+        time.sleep(delay if deadline is None else max(0, min(delay, deadline - time.time())))
+
+        progress = len(instance_ids)
+        still_pending = []
+
+        for chunk in _chunks(pending_ids, EC2_REQUEST_CHUNK):
+            with _profile.timed('api'):
+                updated = conn.get_all_spot_instance_requests(request_ids=chunk)
+
+            for req in updated:
+                if req.instance_id:
+                    instance_ids.append(req.instance_id)
+                    _log("spot ant `{}` joined the hive.".format(req.instance_id))
+                elif req.state in ('cancelled', 'closed', 'failed'):
+                    _log("spot request `{}` was {}: {}".format(req.id, req.state, req.status.code))
+                else:
+                    still_pending.append(req.id)
+
+        pending_ids = still_pending
+        delay = POLL_MIN_DELAY if len(instance_ids) > progress else min(delay * 2, POLL_MAX_DELAY)
+
+        _log('%i of %i spot ants have arrived.' % (len(instance_ids), len(requests)))
+
+    if pending_ids:
+        _log('Cancelling %i outstanding spot requests.' % len(pending_ids))
+
+        for chunk in _chunks(pending_ids, EC2_REQUEST_CHUNK):
+            conn.cancel_spot_instance_requests(chunk)
 
+            # A request can be fulfilled just before it is cancelled, and its instance keeps running
+            for req in conn.get_all_spot_instance_requests(request_ids=chunk):
+                if req.instance_id:
+                    instance_ids.append(req.instance_id)
+                    _log("spot ant `{}` joined the hive.".format(req.instance_id))
+
+    return _describe_instances(conn, instance_ids)
+
+# SSH connections
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+def _connect(params):
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+    timeout = params.get('connect_timeout')
+
+    started = time.time()
+    sock = socket.create_connection((params['instance_name'], SSH_PORT), timeout)
+    _profile.record('connect', params['instance_id'], started)
+
+    started = time.time()
+    try:
         pem_path = params.get('key_name') and _get_pem_path(params['key_name']) or None
-        if not os.path.isfile(pem_path):
+        if not pem_path or not os.path.isfile(pem_path):
             client.load_system_host_keys()
-            client.connect(params['instance_name'], username=params['username'])
+            client.connect(params['instance_name'], port=SSH_PORT, username=params['username'], sock=sock,
+                timeout=timeout, banner_timeout=timeout)
         else:
             client.connect(
                 params['instance_name'],
+                port=SSH_PORT,
                 username=params['username'],
-                key_filename=pem_path)
+                key_filename=pem_path,
+                sock=sock,
+                timeout=timeout,
+                banner_timeout=timeout)
+    except Exception:
+        sock.close()
+        raise
+    _profile.record('auth', params['instance_id'], started)
 
-        order_file = params['order_file']
-        
-        filename = os.path.basename(order_file)
-        print('Ant %s uploading file %s to %s' % (params['i'], order_file, upload_path + filename))
-        command = 'scp -i %s -o StrictHostKeyChecking=no %s %s@%s:%s' % (_get_pem_path(params['key_name']), order_file, params['username'], params['instance_name'], upload_path)
-        os.system(command)
-        
-        print('Ant %s executing file %s' % (params['i'], upload_path + filename))
-        stdin, stdout, stderr = client.exec_command('chmod +x %s'% upload_path + filename)
-        stdin, stdout, stderr = client.exec_command(upload_path + filename)
+    # Keep idle transports alive between orders
+    client.get_transport().set_keepalive(SSH_KEEPALIVE)
 
-        #response = {}
+    return client
 
-        # paramiko's read() returns bytes which need to be converted back to a str
-        #ab_results = IS_PY2 and stdout.read() or stdout.read().decode('utf-8')
-        print(stdout.read().decode('utf-8'))
+def _get_connection(params):
+    """
+    Return a connected SSH client for an ant.
 
-        client.close()
+    Transports are pooled by instance id and reused for every order in the run. A new
+    connection is only made when the ant has none yet or its transport has died. Workers
+    that need more channels than one transport allows ask for a further `connection`.
+    Failed connections are retried with a growing delay, after checking once whether
+    the ant has moved to a new address.
+    """
+    key = (params['instance_id'], params.get('connection', 0))
 
-    except socket.error as e:
-        return e
-    except Exception as e:
-        traceback.print_exc()
-        print()
-        raise e
+    with _connections_lock:
+        client = _connections.get(key)
 
-def order(orders, order_files):
-    username, key_name, zone, instance_ids = _read_server_list()
+    if client is not None:
+        transport = client.get_transport()
+        if transport is not None and transport.is_active():
+            return client
 
-    if not instance_ids:
-        print('No ants are ready for orders.')
-        return
+        _log('Ant %i lost its connection, reconnecting.' % params['i'])
+        client.close()
 
-    print('Connecting to the hive.')
+    retries = params.get('retries', 0)
+    attempt = 0
+    delay = RETRY_DELAY
+    refreshed = False
 
-    ec2_connection = boto.ec2.connect_to_region(_get_region(zone))
+    while True:
+        try:
+            client = _connect(params)
+            break
+        except paramiko.AuthenticationException:
+            raise
+        except (socket.error, EOFError, paramiko.SSHException) as e:
+            # The cached address may be out of date, so look the ant up again before waiting
+            if not refreshed:
+                refreshed = True
+                if _refresh_address(params):
+                    continue
+
+            if attempt >= retries:
+                raise
+
+            attempt += 1
+            _log('Ant %i could not connect (%s), retrying in %is.' % (params['i'], _error_text(e), delay))
+            time.sleep(delay)
+            delay *= 2
+
+    with _connections_lock:
+        _connections[key] = client
+
+    return client
+
+def _refresh_address(params):
+    """
+    Describe an ant again after a failed connection and update its cached details.
 
-    print('Assembling ants.')
+    Returns True when the ant turned out to have a new address. EC2 errors only mean
+    the address could not be checked, so they are logged and False is returned.
+    """
+    try:
+        instances = _describe_instances(_get_ec2_connection(_get_region(params['zone'])), [params['instance_id']])
+    except boto.exception.BotoServerError as e:
+        _log('Could not look up a new address for ant %i: %s' % (params['i'], e.message or e.error_code))
+        return False
 
-    reservations = ec2_connection.get_all_instances(instance_ids=instance_ids)
+    if not instances:
+        return False
 
-    instances = []
+    _update_server_list(instances)
 
-    for reservation in reservations:
-        instances.extend(reservation.instances)
-
-    instance_count = len(instances)
-
-    params = []
-    
-    #Start with executing order
-    if not orders == None:
-        for order in orders:
-            del params[:]
-            for i, instance in enumerate(instances):
-                params.append({
-                    'i': i,
-                    'instance_id': instance.id,
-                    'instance_name': instance.private_dns_name if instance.public_dns_name == "" else instance.public_dns_name,
-                    'username': username,
-                    'key_name': key_name,
-                    'order': order
-            })
+    address = _instance_address(_instance_record(instances[0]))
+    if not address or address == params['instance_name']:
+        return False
 
-            print('Organizing the hive.')
-            # Spin up processes for connecting to EC2 instances
-            pool = Pool(len(params))
-            results = pool.map(_execute_order, params)
-
-    #Now run order files
-    if not order_files == None:
-        for order_file in order_files:
-            print('Filename: %s' % order_file)
-            del params[:]
-            for i, instance in enumerate(instances):
-                params.append({
-                    'i': i,
-                    'instance_id': instance.id,
-                    'instance_name': instance.private_dns_name if instance.public_dns_name == "" else instance.public_dns_name,
-                    'username': username,
-                    'key_name': key_name,
-                    'order_file': order_file
-            })
+    _log('Ant %i has moved to %s.' % (params['i'], address))
+    params['instance_name'] = address
 
-            #print('Running order file %s' % order_file)
+    return True
 
-            print('Organizing the hive.')
-            # Spin up processes for connecting to EC2 instances
-            pool = Pool(len(params))
-            results = pool.map(_execute_order_file, params)
+def _close_connections():
+    with _connections_lock:
+        clients = list(_connections.values())
+        _connections.clear()
 
-    print('The hive is awaiting new orders.')
+    for client in clients:
+        client.close()
+
+# Output
+
+_output_lock = threading.Lock()
+
+def _print_lines(prefix, lines):
+    # Whole lines are written under one lock so output from different ants never interleaves
+    with _output_lock:
+        for line in lines:
+            sys.stdout.write('%s%s\n' % (prefix, line))
+        sys.stdout.flush()
+
+def _log(message):
+    _print_lines('', [message])
+
+def _error_text(e):
+    # Some errors have no message, such as the EOFError of a dropped key exchange
+    return str(e) or e.__class__.__name__
+
+def _stream_lines(prefix, pending, data, final=False):
+    """
+    Print every complete line in the pending bytes plus the new data and return the remainder.
+
+    A partial line is held back until its newline arrives, unless it grows past MAX_LINE_LENGTH.
+    """
+    lines = (pending + data).split(b'\n')
+    pending = lines.pop()
+
+    if final or len(pending) > MAX_LINE_LENGTH:
+        if pending:
+            lines.append(pending)
+        pending = b''
+
+    if lines:
+        # paramiko returns bytes which need to be converted back to a str
+        _print_lines(prefix, [line.decode('utf-8', 'replace') for line in lines])
+
+    return pending
+
+def _run_command(client, command, label, stdin=None, timeout=None, cancel=None, capture=None):
+    """
+    Run a command on an ant, streaming its stdout and stderr as they arrive.
+
+    With a capture the output is written to it instead of being printed.
+
+    When stdin is given it is fed to the command alongside reading its output, so a
+    command that writes while it reads can never stall on a full window. The channel is
+    closed and socket.timeout raised once timeout seconds have passed, or socket.error
+    raised as soon as the cancel event is set.
+
+    Returns the exit status of the command and the number of stdout and stderr bytes.
+    """
+    channel = client.get_transport().open_session()
+    channel.exec_command(command)
+
+    deadline = time.time() + timeout if timeout else None
+
+    stdin_offset = 0
+    if stdin is None:
+        channel.shutdown_write()
+
+    stdout_prefix = 'Ant %s: ' % label
+    stderr_prefix = 'Ant %s (stderr): ' % label
+    stdout_pending = stderr_pending = b''
+    stdout_bytes = stderr_bytes = 0
+
+    # poll rather than select, which cannot watch descriptors numbered above 1023 and
+    # every open transport holds some, so large hives run out of them quickly
+    poller = select.poll()
+    poller.register(channel, select.POLLIN)
+
+    while True:
+        if stdin is not None:
+            if channel.send_ready():
+                stdin_offset += channel.send(stdin[stdin_offset:stdin_offset + OUTPUT_CHUNK_SIZE])
+            if stdin_offset >= len(stdin):
+                channel.shutdown_write()
+                stdin = None
+
+        poller.poll(1000 if stdin is None else 10)
+
+        while channel.recv_ready():
+            data = channel.recv(OUTPUT_CHUNK_SIZE)
+            stdout_bytes += len(data)
+            if capture:
+                capture.write('stdout', data)
+            else:
+                stdout_pending = _stream_lines(stdout_prefix, stdout_pending, data)
+        while channel.recv_stderr_ready():
+            data = channel.recv_stderr(OUTPUT_CHUNK_SIZE)
+            stderr_bytes += len(data)
+            if capture:
+                capture.write('stderr', data)
+            else:
+                stderr_pending = _stream_lines(stderr_prefix, stderr_pending, data)
+
+        if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+            break
+
+        if deadline and time.time() > deadline:
+            channel.close()
+            raise socket.timeout('timed out after %i seconds' % timeout)
+
+        if cancel is not None and cancel.is_set():
+            channel.close()
+            raise socket.error('cancelled, another ant finished this work first')
+
+    _stream_lines(stdout_prefix, stdout_pending, b'', final=True)
+    _stream_lines(stderr_prefix, stderr_pending, b'', final=True)
+
+    status = channel.recv_exit_status()
+    channel.close()
+
+    return status, stdout_bytes, stderr_bytes
+
+def _upload(client, data, remote_path, mode):
+    """
+    Upload a buffer to an ant over SFTP on its pooled transport.
+
+    The mode is set on the open handle before the data goes out, and writes are pipelined
+    so the upload does not wait for an acknowledgement per chunk.
+    """
+    sftp = paramiko.SFTPClient.from_transport(client.get_transport(), window_size=SFTP_WINDOW_SIZE)
+
+    try:
+        remote_file = sftp.open(remote_path, 'wb', bufsize=0)
+        try:
+            remote_file.chmod(mode)
+            remote_file.set_pipelined(True)
+            # Slice the shared buffer so no ant ever holds a second copy of the whole file
+            for offset in range(0, len(data), SFTP_WRITE_SIZE):
+                remote_file.write(data[offset:offset + SFTP_WRITE_SIZE])
+        finally:
+            remote_file.close()
+    finally:
+        sftp.close()
+
+def _check_output(client, command):
+    """
+    Run a short command on an ant and return its exit status and combined output.
+    """
+    channel = client.get_transport().open_session()
+    channel.set_combine_stderr(True)
+    channel.exec_command(command)
+
+    output = channel.makefile('rb').read()
+    status = channel.recv_exit_status()
+    channel.close()
+
+    return status, output.decode('utf-8', 'replace')
+
+def _new_result(params, order):
+    return {
+        'instance_id': params['instance_id'],
+        'ant': params['i'],
+        'order': order,
+        'exit_code': None,
+        'connect_time': 0.0,
+        'upload_time': 0.0,
+        'run_time': 0.0,
+        'stdout_bytes': 0,
+        'stderr_bytes': 0,
+        'chunk': None,
+        'workers': params.get('workers', 1),
+        'timed_out': False,
+        'error': None
+    }
+
+def _ant_label(params):
+    if 'worker' in params:
+        return '%i.%i' % (params['i'], params['worker'])
+    return '%i' % params['i']
+
+def _worker_command(params, command):
+    # Exported rather than prefixed so the variables reach every command in a compound order
+    if 'worker' not in params:
+        return command
+    return 'export HIVEMIND_WORKER=%i HIVEMIND_WORKERS=%i; %s' % (params['worker'], params['workers'], command)
+
+def _shard_command(order, data):
+    """
+    Build the command for one chunk of input.
+
+    An {input} placeholder in the order is replaced by the chunk's lines as shell
+    arguments, with any bytes that are not UTF-8 replaced. Without one, the chunk is
+    piped to the order on stdin unchanged.
+    """
+    if '{input}' in order:
+        lines = [line for line in data.decode('utf-8', 'replace').splitlines() if line]
+        return order.replace('{input}', ' '.join(quote(line) for line in lines)), None
+
+    return order, data
+
+def _progress(params, message):
+    # Aggregated output is about the outcome, so per-ant progress is left out
+    if 'aggregate' not in params:
+        _log(message)
+
+def _add_capture(params, capture, result):
+    if capture:
+        params['aggregate'].add(params['i'], capture, result)
+
+def _execute_order(params):
+    result = _new_result(params, params['order'])
+    command, stdin = params['order'], None
+
+    # Chunks of input bring their own capture, which _execute_shards only keeps for the
+    # copy that finished the chunk
+    capture = params['capture'] if 'capture' in params else _Capture() if 'aggregate' in params else None
+
+    if 'input' in params:
+        result['chunk'] = params['chunk']
+        command, stdin = _shard_command(command, params['input'])
+    else:
+        _progress(params, 'Ant %s is joining the hive.' % _ant_label(params))
+
+    try:
+        started = time.time()
+        client = _get_connection(params)
+        result['connect_time'] = time.time() - started
+
+        if 'input' in params:
+            _progress(params, 'Ant %s is executing order on chunk %i' % (_ant_label(params), params['chunk']))
+        else:
+            _progress(params, 'Ant %s is executing order' % _ant_label(params))
+
+        started = time.time()
+        result['exit_code'], result['stdout_bytes'], result['stderr_bytes'] = _run_command(
+            client, _worker_command(params, command), _ant_label(params), stdin, params.get('order_timeout'), params.get('cancel'), capture)
+        result['run_time'] = _profile.record('exec', params['instance_id'], started)
+
+    except socket.timeout as e:
+        _log('Ant %i gave up on its order: %s' % (params['i'], e))
+        result['error'] = str(e)
+        result['timed_out'] = True
+    except (IOError, EOFError, paramiko.SSHException) as e:
+        _log('Ant %i could not carry out its order: %s' % (params['i'], _error_text(e)))
+        result['error'] = _error_text(e)
+    except Exception as e:
+        traceback.print_exc()
+        print()
+        raise e
+
+    if 'capture' not in params:
+        _add_capture(params, capture, result)
+
+    return result
+
+def _execute_order_file(params):
+    upload_path = UPLOAD_PATH
+    result = _new_result(params, params['order_file'])
+    capture = _Capture() if 'aggregate' in params else None
+
+    _progress(params, 'Ant %s is joining the hive.' % _ant_label(params))
+
+    try:
+        started = time.time()
+        client = _get_connection(params)
+        result['connect_time'] = time.time() - started
+
+        order_file = params['order_file']
+
+        filename = os.path.basename(order_file)
+        if params['instance_id'] not in params.get('distributed', ()):
+            _progress(params, 'Ant %s uploading file %s to %s' % (_ant_label(params), order_file, upload_path + filename))
+            started = time.time()
+            _upload(client, params['order_data'], upload_path + filename, 0o755)
+            result['upload_time'] = _profile.record('upload', params['instance_id'], started)
+
+        _progress(params, 'Ant %s executing file %s' % (_ant_label(params), upload_path + filename))
+        started = time.time()
+        result['exit_code'], result['stdout_bytes'], result['stderr_bytes'] = _run_command(
+            client, _worker_command(params, upload_path + filename), _ant_label(params), None, params.get('order_timeout'), None, capture)
+        result['run_time'] = _profile.record('exec', params['instance_id'], started)
+
+    except socket.timeout as e:
+        _log('Ant %i gave up on its order: %s' % (params['i'], e))
+        result['error'] = str(e)
+        result['timed_out'] = True
+    except (IOError, EOFError, paramiko.SSHException) as e:
+        _log('Ant %i could not carry out its order: %s' % (params['i'], _error_text(e)))
+        result['error'] = _error_text(e)
+    except Exception as e:
+        traceback.print_exc()
+        print()
+        raise e
+
+    _add_capture(params, capture, result)
+
+    return result
+
+# Distribution
+
+def _authorize_relay(params):
+    try:
+        client = _get_connection(params)
+        status, output = _check_output(client, params['command'])
+        return status == 0
+    except (socket.error, EOFError, paramiko.SSHException) as e:
+        _log('Ant %i could not join the relay: %s' % (params['i'], _error_text(e)))
+        return False
+
+def _upload_to_ant(params):
+    try:
+        _upload(_get_connection(params), params['order_data'], params['remote_path'], 0o755)
+    except (IOError, EOFError, paramiko.SSHException) as e:
+        _log('Ant %i could not receive %s: %s' % (params['i'], params['remote_path'], _error_text(e)))
+
+def _relay_file(params):
+    """
+    Have an ant that holds the file copy it on to its children over the private network.
+    """
+    try:
+        client = _get_connection(params)
+        _upload(client, params['relay_key'], RELAY_KEY_PATH, 0o600)
+    except (IOError, EOFError, paramiko.SSHException) as e:
+        _log('Ant %i could not relay %s: %s' % (params['i'], params['remote_path'], _error_text(e)))
+        return
+
+    copies = ['scp -p -q -i %s -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o BatchMode=yes -o ConnectTimeout=10 %s %s' % (
+        RELAY_KEY_PATH, quote(params['remote_path']), quote('%s@%s:%s' % (child['username'], child['private_address'], params['remote_path'])))
+        for child in params['children']]
+
+    status, output = _check_output(client, ' & '.join(copies) + ' & wait')
+    if output.strip():
+        _print_lines('Ant %i (relay): ' % params['i'], output.strip().split('\n'))
+
+def _verify_file(params):
+    try:
+        status, output = _check_output(_get_connection(params), 'sha256sum %s' % quote(params['remote_path']))
+    except (socket.error, EOFError, paramiko.SSHException):
+        return False
+
+    return status == 0 and output.split(' ')[0] == params['digest']
+
+def _distribute_file(pool, ants, step, fanout):
+    """
+    Copy an order file to every ant through a relay tree.
+
+    The controller uploads the file to `fanout` seed ants only. In every following round
+    each ant that holds a verified copy forwards it to up to `fanout` more ants over the
+    private network, so the number of holders multiplies each round. Every copy is checked
+    against the file's sha256 digest, and ants whose copy fails fall back to a direct upload.
+
+    A throwaway key pair is authorized on the ants for the ant-to-ant copies and removed
+    again afterwards.
+    """
+    remote_path = UPLOAD_PATH + os.path.basename(step['order_file'])
+    digest = hashlib.sha256(step['order_data']).hexdigest()
+    token = 'hivemind-relay-%s' % digest[:12]
+
+    key = paramiko.RSAKey.generate(2048)
+    key_text = StringIO()
+    key.write_private_key(key_text)
+    public_key = '%s %s %s' % (key.get_name(), key.get_base64(), token)
+
+    base = {'remote_path': remote_path, 'digest': digest, 'order_data': step['order_data']}
+
+    authorize = 'mkdir -p ~/.ssh && chmod 700 ~/.ssh && echo %s >> ~/.ssh/authorized_keys' % quote(public_key)
+    authorized = pool.map(_authorize_relay, [dict(ant, command=authorize) for ant in ants])
+    waiting = [ant for ant, ok in zip(ants, authorized) if ok and ant.get('private_address')]
+
+    try:
+        seeds, waiting = waiting[:fanout], waiting[fanout:]
+        print('Seeding %s to %i ants.' % (step['order_file'], len(seeds)))
+        pool.map(_upload_to_ant, [dict(ant, **base) for ant in seeds])
+
+        verified = pool.map(_verify_file, [dict(ant, **base) for ant in seeds])
+        holders = [ant for ant, ok in zip(seeds, verified) if ok]
+        failed = [ant for ant, ok in zip(seeds, verified) if not ok]
+
+        while waiting and holders:
+            relays = []
+            for holder in holders:
+                children, waiting = waiting[:fanout], waiting[fanout:]
+                if children:
+                    relays.append(dict(holder, children=children, relay_key=key_text.getvalue().encode('utf-8'), **base))
+
+            print('Relaying %s to %i ants.' % (step['order_file'], sum(len(r['children']) for r in relays)))
+            pool.map(_relay_file, relays)
+
+            children = [child for relay in relays for child in relay['children']]
+            verified = pool.map(_verify_file, [dict(child, **base) for child in children])
+            holders += [ant for ant, ok in zip(children, verified) if ok]
+            failed += [ant for ant, ok in zip(children, verified) if not ok]
+
+        # Anything the tree could not reach gets the file straight from the controller
+        direct = failed + waiting
+        if direct:
+            print('Uploading %s directly to %i ants.' % (step['order_file'], len(direct)))
+            pool.map(_upload_to_ant, [dict(ant, **base) for ant in direct])
+            verified = pool.map(_verify_file, [dict(ant, **base) for ant in direct])
+            holders += [ant for ant, ok in zip(direct, verified) if ok]
+    finally:
+        revoke = "sed -i '/%s/d' ~/.ssh/authorized_keys; rm -f %s" % (token, RELAY_KEY_PATH)
+        pool.map(_authorize_relay, [dict(ant, command=revoke) for ant in ants])
+
+    return set(ant['instance_id'] for ant in holders)
+
+# Syncing directories
+
+def _build_manifest(root):
+    """
+    Describe every regular file under root by its mode, size and the sha1 of each block.
+    """
+    files = {}
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            relative = os.path.relpath(path, root).replace(os.sep, '/')
+
+            if os.path.islink(path) or not os.path.isfile(path) or relative == SYNC_MANIFEST:
+                continue
+
+            with open(path, 'rb') as f:
+                blocks = [hashlib.sha1(block).hexdigest() for block in iter(lambda: f.read(SYNC_BLOCK_SIZE), b'')]
+
+            files[relative] = {
+                'mode': 0o755 if os.stat(path).st_mode & 0o111 else 0o644,
+                'size': os.path.getsize(path),
+                'blocks': blocks
+            }
+
+    return {'block_size': SYNC_BLOCK_SIZE, 'files': files}
+
+def _read_remote_manifest(sftp, path):
+    try:
+        with sftp.open(path, 'rb') as f:
+            manifest = json.loads(f.read().decode('utf-8'))
+    except (IOError, ValueError):
+        return {}
+
+    if manifest.get('block_size') != SYNC_BLOCK_SIZE:
+        return {}
+
+    return manifest.get('files', {})
+
+def _sync_file(sftp, local_path, remote_path, entry, previous):
+    """
+    Bring one remote file in line with its manifest entry and return the bytes sent.
+
+    New files are sent whole. Files the ant already has only get the blocks whose hash
+    changed, and are then cut to the new size.
+    """
+    if previous is None:
+        changed = range(len(entry['blocks']))
+    else:
+        changed = [n for n, digest in enumerate(entry['blocks'])
+                   if n >= len(previous['blocks']) or previous['blocks'][n] != digest]
+
+    sent = 0
+
+    if changed or previous is None or previous['size'] != entry['size']:
+        remote_file = sftp.open(remote_path, 'wb' if previous is None else 'r+b', bufsize=0)
+        try:
+            remote_file.set_pipelined(True)
+
+            with open(local_path, 'rb') as local_file:
+                for n in changed:
+                    local_file.seek(n * SYNC_BLOCK_SIZE)
+                    block = local_file.read(SYNC_BLOCK_SIZE)
+                    remote_file.seek(n * SYNC_BLOCK_SIZE)
+                    for offset in range(0, len(block), SFTP_WRITE_SIZE):
+                        remote_file.write(block[offset:offset + SFTP_WRITE_SIZE])
+                    sent += len(block)
+
+            if previous is not None and previous['size'] != entry['size']:
+                remote_file.truncate(entry['size'])
+        finally:
+            remote_file.close()
+
+    if previous is None or previous['mode'] != entry['mode']:
+        sftp.chmod(remote_path, entry['mode'])
+
+    return sent
+
+def _sync_to_ant(params):
+    """
+    Make an ant's copy of the synced directory match the local one.
+
+    The ant keeps the manifest of its copy next to the files. When the sha256 of that
+    manifest matches the local one, which takes a single command, nothing else happens.
+    Otherwise the manifest is fetched and only missing or changed blocks are written.
+    The manifest is removed before any file changes and replaced once all of them are
+    done, so an interrupted sync is never mistaken for a finished one.
+    """
+    root, remote_dir = params['sync_dir'], params['sync_path']
+    manifest_path = remote_dir + '/' + SYNC_MANIFEST
+    result = _new_result(params, 'sync %s' % root)
+
+    try:
+        started = time.time()
+        client = _get_connection(params)
+        result['connect_time'] = time.time() - started
+
+        started = time.time()
+        status, output = _check_output(client, 'sha256sum %s 2>/dev/null' % quote(manifest_path))
+
+        if status == 0 and output.split(' ')[0] == params['sync_digest']:
+            _log('Ant %i already has %s.' % (params['i'], remote_dir))
+        else:
+            files = params['sync_manifest']['files']
+            directories = set(remote_dir + '/' + os.path.dirname(path) for path in files)
+            _check_output(client, 'mkdir -p %s' % ' '.join(quote(d.rstrip('/')) for d in sorted(directories | set([remote_dir]))))
+
+            sftp = paramiko.SFTPClient.from_transport(client.get_transport(), window_size=SFTP_WINDOW_SIZE)
+            try:
+                previous = _read_remote_manifest(sftp, manifest_path)
+                if previous:
+                    sftp.remove(manifest_path)
+
+                sent = 0
+                for path, entry in sorted(files.items()):
+                    sent += _sync_file(sftp, os.path.join(root, path), remote_dir + '/' + path, entry, previous.get(path))
+
+                for path in set(previous) - set(files):
+                    try:
+                        sftp.remove(remote_dir + '/' + path)
+                    except IOError:
+                        pass
+
+                with sftp.open(manifest_path + '.new', 'wb') as f:
+                    f.write(params['sync_data'])
+                sftp.posix_rename(manifest_path + '.new', manifest_path)
+            finally:
+                sftp.close()
+
+            _log('Ant %i synced %s (%i bytes sent).' % (params['i'], remote_dir, sent))
+
+        result['upload_time'] = _profile.record('upload', params['instance_id'], started)
+        result['exit_code'] = 0
+    except (IOError, EOFError, paramiko.SSHException) as e:
+        _log('Ant %i could not sync %s: %s' % (params['i'], remote_dir, _error_text(e)))
+        result['error'] = _error_text(e)
+
+    return result
+
+def _sync_hive(pool, ants, sync_dir):
+    """
+    Sync a local directory to UPLOAD_PATH/<name of the directory>/ on every ant.
+
+    Returns the ants whose copy is up to date.
+    """
+    sync_dir = os.path.abspath(sync_dir)
+    manifest = _build_manifest(sync_dir)
+    data = json.dumps(manifest, sort_keys=True).encode('utf-8')
+
+    base = {
+        'sync_dir': sync_dir,
+        'sync_path': UPLOAD_PATH + os.path.basename(sync_dir),
+        'sync_manifest': manifest,
+        'sync_data': data,
+        'sync_digest': hashlib.sha256(data).hexdigest()
+    }
+
+    print('Syncing %s (%i files) to %s.' % (sync_dir, len(manifest['files']), base['sync_path']))
+
+    results = pool.map(_sync_to_ant, [dict(ant, **base) for ant in ants])
+
+    for ant, result in zip(ants, results):
+        ant['results'].add(result)
+
+    return [ant for ant, result in zip(ants, results) if not result['error']]
+
+# Scheduling
+
+RATE_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+
+def _parse_rate(rate):
+    """
+    Parse a launch rate such as "20/s", "300/m" or "20" into ants per second.
+    """
+    match = re.match(r'^\s*([0-9]*\.?[0-9]+)\s*(?:/\s*([smh]))?\s*$', rate)
+    if not match or float(match.group(1)) <= 0:
+        raise ValueError('%s is not a rate like 20/s' % rate)
+
+    return float(match.group(1)) / RATE_UNITS[match.group(2) or 's']
+
+def _parse_stages(stages):
+    """
+    Parse stages such as "10@0,50@30,200@60" into (count, seconds) pairs.
+    """
+    try:
+        parsed = [(int(count), float(seconds)) for count, seconds in
+                  (stage.strip().split('@') for stage in stages.split(',') if stage.strip())]
+    except ValueError:
+        raise ValueError('%s is not a list of stages like 10@0,50@30' % stages)
+
+    if not parsed or any(b[0] <= a[0] or b[1] < a[1] for a, b in zip(parsed, parsed[1:])):
+        raise ValueError('stages need counts that grow and times that do not go back: %s' % stages)
+
+    return parsed
+
+class _Schedule(object):
+    """
+    Decide when each ant may start working.
+
+    A rate starts ants one after another at that many per second. A ramp alone spreads
+    the starts evenly over its length, and together with a rate raises the rate linearly
+    from nothing to the full rate over its length. Stages such as "10@0,50@30" allow
+    COUNT ants to have started SECONDS into the run, and the last stage releases every ant
+    beyond its COUNT too. A start waits for every limit that applies. With max_active, no
+    more than that many ants are working at the same time and the next ant starts as soon
+    as one finishes.
+    """
+    def __init__(self, rate=None, ramp=None, stages=None, max_active=None):
+        self.rate = _parse_rate(rate) if rate else None
+        self.ramp = float(ramp) if ramp else None
+        self.stages = _parse_stages(stages) if stages else []
+        self.max_active = max_active
+        self.active = threading.BoundedSemaphore(max_active) if max_active else None
+        self.lock = threading.Lock()
+        self.start(0)
+
+    def __str__(self):
+        limits = []
+        if self.rate:
+            limits.append('%g per second' % self.rate)
+        if self.ramp:
+            limits.append('ramping up over %gs' % self.ramp)
+        if self.stages:
+            limits.append('in stages of %s' % ', '.join('%i by %gs' % stage for stage in self.stages))
+        if self.max_active:
+            limits.append('at most %i active' % self.max_active)
+        return ', '.join(limits)
+
+    def start(self, total):
+        """
+        Begin a wave of `total` starts, timed from now.
+        """
+        with self.lock:
+            self.started = time.time()
+            self.launched = 0
+            self.total = total
+
+    def offset(self, n):
+        """
+        Return how many seconds into the wave the n-th start may happen.
+        """
+        offset = 0.0
+
+        if self.rate and self.ramp:
+            # The number of starts by time t is rate * t^2 / (2 * ramp) during the ramp
+            ramp_starts = self.rate * self.ramp / 2
+            if n <= ramp_starts:
+                offset = math.sqrt(2 * self.ramp * n / self.rate)
+            else:
+                offset = self.ramp + (n - ramp_starts) / self.rate
+        elif self.rate:
+            offset = n / self.rate
+        elif self.ramp and self.total:
+            offset = self.ramp * n / self.total
+
+        if self.stages:
+            # Ants beyond the last COUNT are not held back any further than the last stage
+            seconds = [s for count, s in self.stages if n < count]
+            offset = max(offset, seconds[0] if seconds else self.stages[-1][1])
+
+        return offset
+
+    @contextmanager
+    def slot(self):
+        if self.active:
+            self.active.acquire()
+
+        try:
+            with self.lock:
+                n = self.launched
+                self.launched += 1
+
+            delay = self.started + self.offset(n) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            yield
+        finally:
+            if self.active:
+                self.active.release()
+
+def _launch(schedule, function, params):
+    with schedule.slot():
+        return function(params)
+
+# Aggregated output
+
+class _Capture(object):
+    """
+    Hold the stdout and stderr of one run, hashing them as they arrive.
+
+    Each stream is kept in memory up to AGGREGATE_SPOOL_SIZE and on disk beyond that.
+    """
+    def __init__(self):
+        self.spools = {}
+        self.hashes = {}
+        for stream in ['stdout', 'stderr']:
+            self.spools[stream] = tempfile.SpooledTemporaryFile(max_size=AGGREGATE_SPOOL_SIZE)
+            self.hashes[stream] = hashlib.sha1()
+
+    def write(self, stream, data):
+        self.spools[stream].write(data)
+        self.hashes[stream].update(data)
+
+    def digest(self):
+        return (self.hashes['stdout'].hexdigest(), self.hashes['stderr'].hexdigest())
+
+    def lines(self):
+        lines = []
+        for stream, prefix in [('stdout', ''), ('stderr', '(stderr) ')]:
+            self.spools[stream].seek(0)
+            data = self.spools[stream].read().decode('utf-8', 'replace')
+            lines.extend(prefix + line for line in data.splitlines())
+        return lines
+
+    def close(self):
+        for spool in self.spools.values():
+            spool.close()
+
+def _ant_ranges(ants):
+    """
+    Write ant numbers compactly, folding consecutive ants into ranges.
+    """
+    numbers = sorted(set(ants))
+    ranges = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+
+    return ', '.join('%i' % a if a == b else '%i-%i' % (a, b) for a, b in ranges)
+
+class _Aggregate(object):
+    """
+    Group the output of every ant for one order and print each distinct output once.
+
+    Runs with the same stdout, stderr, exit code and error fall into one group. Only the
+    first capture of a group is kept, along with its number of runs and the ants they ran
+    on, so memory grows with the number of distinct outputs rather than the number of
+    runs. An ant can run an order several times, once per worker or chunk. With diff, the
+    most common output is printed in full and every other one only as its differences
+    from it.
+    """
+    def __init__(self, diff=False):
+        self.diff = diff
+        self.lock = threading.Lock()
+        self.groups = {}
+
+    def add(self, ant, capture, result):
+        key = capture.digest() + (result['exit_code'], result['error'])
+
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                self.groups[key] = {'runs': 1, 'ants': set([ant]), 'capture': capture, 'result': result}
+                return
+            group['runs'] += 1
+            group['ants'].add(ant)
+
+        capture.close()
+
+    def report(self):
+        groups = sorted(self.groups.values(), key=lambda group: group['runs'], reverse=True)
+        common = None
+
+        for group in groups:
+            result = group['result']
+            if result['error']:
+                outcome = 'failed: %s' % result['error']
+            else:
+                outcome = 'exited with %s' % result['exit_code']
+
+            if group['runs'] == len(group['ants']):
+                print('%i ants (%s) %s' % (len(group['ants']), _ant_ranges(group['ants']), outcome))
+            else:
+                print('%i runs on %i ants (%s) %s' % (group['runs'], len(group['ants']), _ant_ranges(group['ants']), outcome))
+
+            lines = group['capture'].lines()
+
+            if self.diff and common is not None:
+                # Skip the two file header lines, every ant here is compared to the same output
+                diff = list(difflib.unified_diff(common, lines, lineterm='', n=1))[2:]
+                _print_lines('  ', diff or ['(same output as above)'])
+            else:
+                _print_lines('  ', lines)
+
+            if common is None:
+                common = lines
+
+    def close(self):
+        for group in self.groups.values():
+            group['capture'].close()
+
+# Results
+
+RESULT_FIELDS = ['instance_id', 'ant', 'order', 'chunk', 'workers', 'exit_code', 'connect_time', 'upload_time', 'run_time', 'stdout_bytes', 'stderr_bytes', 'timed_out', 'error']
+
+class _Results(object):
+    """
+    Count order results and, when a path is given, append each one to a JSONL or CSV file.
+
+    Results are written as they come in, so memory does not grow with the size of the run.
+    """
+    def __init__(self, path=None):
+        self.total = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.file = None
+        self.writer = None
+
+        if path:
+            self.file = open(path, 'w')
+            if path.endswith('.csv'):
+                self.writer = csv.DictWriter(self.file, RESULT_FIELDS, extrasaction='ignore')
+                self.writer.writeheader()
+
+    def add(self, result):
+        with self.lock:
+            self.total += 1
+            if result['error'] or result['exit_code'] != 0:
+                self.failed += 1
+
+            if self.writer:
+                self.writer.writerow(result)
+            elif self.file:
+                self.file.write(json.dumps(result, sort_keys=True) + '\n')
+
+            if self.file:
+                self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+# Sharded work
+
+class _WorkQueue(object):
+    """
+    Hand out chunks of an input file to ants as they ask for work.
+
+    Ants that finish quickly simply come back for more, so the hive is done when the
+    work is done. The file is read lazily. Chunks whose run failed are handed out again
+    first, up to `retries` more times.
+
+    With hedging, ants that run out of work stay around, and once a chunk has been
+    running for `hedge` times the p95 of finished chunks, a second copy is handed to an
+    idle ant. Whichever copy finishes first wins and the other one is cancelled.
+    """
+    def __init__(self, path, chunk_size, retries=0, hedge=0):
+        self.file = open(path, 'rb')
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.hedge = hedge
+        self.lock = threading.Lock()
+        self.returned = []
+        self.running = {}
+        self.attempts = {}
+        self.durations = []
+        self.count = 0
+
+    def get(self, lines=None):
+        """
+        Return the next (index, data, cancel event) to work on, None when all the work is
+        done, or False when the ant should wait a moment, either for a straggler to hedge
+        or for a running chunk that may still fail and be handed out again.
+
+        A new chunk holds `lines` lines when given, and chunk_size otherwise.
+        """
+        with self.lock:
+            if self.returned:
+                index, data = self.returned.pop()
+            else:
+                data = b''.join(itertools.islice(self.file, lines or self.chunk_size))
+                index = self.count
+
+                if data:
+                    self.count += 1
+                    self.attempts[index] = 0
+
+            if data:
+                self.attempts[index] += 1
+                self.running[index] = {'data': data, 'started': time.time(), 'copies': 1, 'cancel': threading.Event()}
+                return (index, data, self.running[index]['cancel'])
+
+            if not self.running:
+                return None
+
+            # A running chunk that can still fail and be retried needs ants to stay around
+            if not self.hedge and all(self.attempts[index] > self.retries for index in self.running):
+                return None
+
+            if self.hedge and len(self.durations) >= HEDGE_MIN_SAMPLES:
+                limit = self.hedge * _percentile(sorted(self.durations), 95)
+
+                for index, entry in self.running.items():
+                    if entry['copies'] == 1 and time.time() - entry['started'] > limit:
+                        entry['copies'] += 1
+                        return (index, entry['data'], entry['cancel'])
+
+            return False
+
+    def complete(self, index):
+        """
+        Mark a chunk as done. Returns False when another copy had already finished it.
+        """
+        with self.lock:
+            entry = self.running.pop(index, None)
+            if entry is None:
+                return False
+
+            self.durations.append(time.time() - entry['started'])
+            entry['cancel'].set()
+            return True
+
+    def fail(self, index):
+        """
+        Note that a copy of a chunk could not be run, and queue the chunk again once no
+        copy of it is left running.
+        """
+        with self.lock:
+            entry = self.running.get(index)
+            if entry is None:
+                return
+
+            entry['copies'] -= 1
+            if entry['copies'] == 0:
+                del self.running[index]
+                if self.attempts[index] <= self.retries:
+                    self.returned.append((index, entry['data']))
+
+    def finished(self):
+        """
+        Return whether all of the input was run, or given up on after its retries.
+        """
+        with self.lock:
+            return not self.returned and not self.running and not self.file.readline()
+
+    def close(self):
+        self.file.close()
+
+def _execute_shards(params):
+    """
+    Keep running the order on chunks from the work queue until all the work is done.
+
+    Returns the result of the chunk the ant could not connect for, if any.
+    """
+    work = params['work']
+
+    while True:
+        chunk = work.get(params.get('chunk_lines'))
+        if chunk is None:
+            return None
+
+        if chunk is False:
+            time.sleep(WORK_POLL_DELAY)
+            continue
+
+        index, data, cancel = chunk
+        capture = _Capture() if 'aggregate' in params else None
+        result = _execute_order(dict(params, chunk=index, input=data, cancel=cancel, capture=capture))
+
+        if not result['error']:
+            # A copy that lost the race has nothing left to report
+            if work.complete(index):
+                params['results'].add(result)
+                _add_capture(params, capture, result)
+            elif capture:
+                capture.close()
+            continue
+
+        if cancel.is_set():
+            if capture:
+                capture.close()
+            continue
+
+        work.fail(index)
+        params['results'].add(result)
+        _add_capture(params, capture, result)
+
+        # The ant could not be reached, so leave the rest of the work to the hive
+        if not result['timed_out']:
+            return result
+
+_cores = {}
+_cores_lock = threading.Lock()
+
+def _worker_count(params):
+    """
+    Return how many copies of each order an ant runs at once.
+
+    With "auto" the cores found by report --probe are used, or else the ant is asked
+    for its number of cores, once per ant.
+    """
+    if params['concurrency'] != 'auto':
+        return int(params['concurrency'])
+
+    if params.get('cores'):
+        return params['cores']
+
+    with _cores_lock:
+        cores = _cores.get(params['instance_id'])
+
+    if cores is None:
+        status, output = _check_output(_get_connection(params), 'nproc')
+        cores = int(output.strip()) if status == 0 and output.strip().isdigit() else 1
+        _log('Ant %i has %i cores.' % (params['i'], cores))
+
+        with _cores_lock:
+            _cores[params['instance_id']] = cores
+
+    return cores
+
+def _combine_results(results):
+    """
+    Fold the results of every copy of an order on one ant into a single result.
+
+    The ant fails when any copy fails, and reports the first failure.
+    """
+    combined = dict(results[0], workers=len(results))
+
+    for field in ['stdout_bytes', 'stderr_bytes']:
+        combined[field] = sum(result[field] for result in results)
+    for field in ['connect_time', 'upload_time', 'run_time']:
+        combined[field] = max(result[field] for result in results)
+    combined['timed_out'] = any(result['timed_out'] for result in results)
+
+    failed = [result for result in results if result['error'] or result['exit_code'] != 0]
+    if failed:
+        combined['exit_code'] = failed[0]['exit_code']
+        combined['error'] = failed[0]['error']
+
+    return combined
+
+def _execute_workers(params, execute):
+    """
+    Run `execute` for one step as several workers on the same ant.
+
+    Each worker is told its index through HIVEMIND_WORKER. Workers share the ant's
+    pooled transport, and open another one for every SSH_MAX_SESSIONS workers since
+    sshd limits the sessions on a connection. An order file is uploaded once for all
+    of them.
+    """
+    try:
+        workers = _worker_count(params)
+
+        # Connect up front so the workers sharing a transport do not race to open it
+        for connection in range((workers - 1) // SSH_MAX_SESSIONS + 1):
+            _get_connection(dict(params, connection=connection))
+    except (IOError, EOFError, paramiko.SSHException):
+        # A single worker reports the failure the same way an order does without workers
+        workers = 1
+
+    upload_time = 0.0
+    if 'order_file' in params and params['instance_id'] not in params.get('distributed', ()):
+        result = _new_result(params, params['order_file'])
+        try:
+            client = _get_connection(params)
+            started = time.time()
+            _upload(client, params['order_data'], UPLOAD_PATH + os.path.basename(params['order_file']), 0o755)
+            upload_time = _profile.record('upload', params['instance_id'], started)
+        except (IOError, EOFError, paramiko.SSHException) as e:
+            _log('Ant %i could not carry out its order: %s' % (params['i'], _error_text(e)))
+            result['error'] = _error_text(e)
+            return [result]
+
+        params = dict(params, distributed=set([params['instance_id']]))
+
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(execute, [dict(params, worker=k, workers=workers, connection=k // SSH_MAX_SESSIONS) for k in range(workers)])
+    finally:
+        pool.close()
+        pool.join()
+
+    for result in results:
+        if result:
+            result['upload_time'] = upload_time
+
+    return results
+
+def _execute_step(params):
+    if 'work' in params:
+        if params.get('concurrency'):
+            # Every worker takes its own chunks, so the first connection failure is all that is left to report
+            return next((result for result in _execute_workers(params, _execute_shards) if result), None)
+        return _execute_shards(params)
+
+    execute = _execute_order_file if 'order_file' in params else _execute_order
+
+    if params.get('concurrency'):
+        result = _combine_results(_execute_workers(params, execute))
+    else:
+        result = execute(params)
+
+    params['results'].add(result)
+
+    return result
+
+def _execute_pipeline(params):
+    for step in params['steps']:
+        result = _execute_step(dict(params, **step))
+
+        # An ant that could not be reached for one step is skipped for the rest
+        if result and result['error']:
+            return
+
+def _assemble_ants(**params):
+    """
+    Read the running ants from the roster, or from EC2 when the roster is stale.
+
+    Returns one dict per ant with everything needed to connect to it, plus `params`.
+    """
+    state = _load_state()
+
+    if state is None or not state['instances']:
+        return []
+
+    username, key_name, zone = state['username'], state['key_name'], state['zone']
+    probes = dict((r['id'], r['probe']) for r in state['instances'] if _probe_is_fresh(r.get('probe')))
+
+    print('Read %i bees from the roster.' % len(state['instances']))
+
+    if _state_is_fresh(state):
+        print('Assembling ants from the roster.')
+
+        records = state['instances']
+    else:
+        print('Connecting to the hive.')
+        print('Assembling ants.')
+
+        instances = _describe_hive(state)
+        _update_server_list(instances)
+
+        records = [_instance_record(instance) for instance in instances]
+
+    records = [r for r in records if r['state'] == 'running']
+
+    return [dict(params,
+        i=i,
+        instance_id=record['id'],
+        instance_name=_instance_address(record),
+        private_address=record.get('private_ip_address'),
+        zone=record.get('zone') or zone,
+        username=username,
+        key_name=key_name,
+        probe=probes.get(record['id'])
+    ) for i, record in enumerate(records)]
+
+def _report_aggregate(step):
+    if 'aggregate' in step:
+        print('Output of %s:' % step.get('order_file', step.get('order')))
+        step['aggregate'].report()
+
+def _weigh_ants(ants, chunk_size, concurrency):
+    """
+    Size each ant's share of the work by the cores it had to spare at the last probe.
+
+    With --per-ant-concurrency auto an ant runs one worker per spare core. Otherwise its
+    chunks of --input are as many times chunk_size as it has spare cores for every
+    spare core of the least capable ant.
+    """
+    free = dict((ant['instance_id'], _free_cores(ant['probe'])) for ant in ants
+                if ant['probe'] and 'error' not in ant['probe'])
+
+    if not free:
+        print('No recent probes to weigh the ants by. Run report --probe first.')
+        return
+
+    least = min(free.values())
+
+    for ant in ants:
+        if ant['instance_id'] not in free:
+            continue
+
+        if concurrency == 'auto':
+            ant['cores'] = free[ant['instance_id']]
+        elif not concurrency:
+            ant['chunk_lines'] = chunk_size * free[ant['instance_id']] // least
+
+def order(orders, order_files, parallel=DEFAULT_PARALLEL, pipeline=False, fanout=0, results_path=None, profile_path=None, input_path=None, chunk_size=DEFAULT_CHUNK_SIZE,
+          connect_timeout=DEFAULT_CONNECT_TIMEOUT, order_timeout=None, retries=DEFAULT_RETRIES, hedge=0, sync_dir=None,
+          rate=None, ramp=None, stages=None, max_active=None, concurrency=None, max_load=None, weighted=False, aggregate=None):
+    _profile.reset()
+
+    try:
+        schedule = _Schedule(rate, ramp, stages, max_active)
+    except ValueError as e:
+        print('Cannot schedule the hive: %s.' % e)
+        sys.exit(2)
+
+    ants = _assemble_ants(connect_timeout=connect_timeout, order_timeout=order_timeout, retries=retries, concurrency=concurrency)
+
+    if max_load is not None:
+        # Ants without a recent probe are given the benefit of the doubt
+        skipped = set(ant['instance_id'] for ant in ants if ant['probe'] and (
+            'error' in ant['probe'] or ant['probe']['load'] / ant['probe']['cores'] > max_load))
+        if skipped:
+            print('Skipping %i ants that were overloaded or unreachable at the last probe.' % len(skipped))
+            ants = [ant for ant in ants if ant['instance_id'] not in skipped]
+
+            if not ants:
+                print('No ants are ready for orders, every one was skipped for --max-load.')
+                sys.exit(1)
+
+    for ant in ants:
+        if ant['probe'] and 'error' not in ant['probe']:
+            ant['cores'] = ant['probe']['cores']
+
+    if weighted:
+        _weigh_ants(ants, chunk_size, concurrency)
+
+    if not ants:
+        print('No ants are ready for orders.')
+        return
+
+    instance_count = len(ants)
+
+    results = _Results(results_path)
+    for ant in ants:
+        ant['results'] = results
+
+    # Orders run before order files, each in the order given
+    steps = [{'order': order} for order in orders or []]
+
+    if input_path:
+        # Each order works through the whole input, one chunk at a time on whichever ant is free
+        for step in steps:
+            step['work'] = _WorkQueue(input_path, chunk_size, retries, hedge)
+
+    for order_file in order_files or []:
+        # Read each file once and share the buffer between every ant
+        with open(order_file, 'rb') as f:
+            steps.append({'order_file': order_file, 'order_data': f.read()})
+
+    if aggregate:
+        for step in steps:
+            step['aggregate'] = _Aggregate(aggregate == 'diff')
+
+    # One bounded pool of worker threads drives every order in the run. Ants held back
+    # by --max-active wait for a slot rather than for a worker thread.
+    pool = ThreadPool(max(1, min(max(int(parallel), max_active or 0), instance_count)))
+
+    try:
+        if sync_dir:
+            # Ants that could not get the directory have nothing to run their orders on
+            ants = _sync_hive(pool, ants, sync_dir)
+
+        if fanout:
+            for step in steps:
+                if 'order_file' in step:
+                    step['distributed'] = _distribute_file(pool, ants, step, fanout)
+
+        if str(schedule):
+            print('Scheduling ants: %s.' % schedule)
+
+        if pipeline:
+            # Every ant works through all of its steps on its own, and the hive only meets at the end
+            print('Organizing the hive.')
+            schedule.start(len(ants))
+            pool.map(lambda params: _launch(schedule, _execute_pipeline, params), [dict(ant, steps=steps) for ant in ants])
+
+            for step in steps:
+                _report_aggregate(step)
+        else:
+            # Every ant finishes a step before any ant starts the next one
+            for step in steps:
+                if 'order_file' in step:
+                    print('Filename: %s' % step['order_file'])
+
+                print('Organizing the hive.')
+                schedule.start(len(ants))
+                pool.map(lambda params: _launch(schedule, _execute_step, params), [dict(ant, **step) for ant in ants])
+
+                _report_aggregate(step)
+
+        # Every ant may have left while chunks were still waiting to be run again
+        unfinished = [step for step in steps if 'work' in step and not step['work'].finished()]
+    finally:
+        pool.close()
+        pool.join()
+        if not KEEP_CONNECTIONS:
+            _close_connections()
+        results.close()
+
+        for step in steps:
+            if 'work' in step:
+                step['work'].close()
+            if 'aggregate' in step:
+                step['aggregate'].close()
+
+    _profile.summary()
+    if profile_path:
+        _profile.write_trace(profile_path)
+
+    if results.failed:
+        print('%i of %i orders failed.' % (results.failed, results.total))
+
+    for step in unfinished:
+        print('Part of the input was never run for %s, as no ant was left to take it.' % step['order'])
+
+    print('The hive is awaiting new orders.')
+
+    sys.exit(1 if results.failed or unfinished else 0)
+
+# Collecting files
+
+def _collect_command(remote_glob):
+    # The glob is left unquoted so the ant's shell expands it. Exiting before tar when
+    # nothing matches sends back no archive at all rather than an error.
+    return 'set -- %s; [ -e "$1" ] || [ -L "$1" ] || exit %i; tar -czf - "$@"' % (remote_glob, COLLECT_NO_MATCH)
+
+def _local_path(root, name):
+    """
+    Return where an archive member belongs under root, or None if it would land outside it.
+    """
+    path = os.path.normpath(os.path.join(root, name))
+
+    if os.path.isabs(name) or not path.startswith(root + os.sep):
+        return None
+
+    return path
+
+def _extract_stream(stream, root):
+    """
+    Unpack a gzipped tar stream under root one member at a time, never holding a whole file.
+
+    Only directories and regular files are written. Links, devices and any member whose
+    path would escape root are skipped. Returns the number of files and bytes written.
+    """
+    files = size = 0
+
+    archive = tarfile.open(fileobj=stream, mode='r|gz')
+
+    try:
+        for member in archive:
+            path = _local_path(root, member.name)
+
+            if path is None or not (member.isdir() or member.isfile()):
+                _log('Skipping %s.' % member.name)
+                continue
+
+            if member.isdir():
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                continue
+
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            with open(path, 'wb') as local_file:
+                shutil.copyfileobj(archive.extractfile(member), local_file, OUTPUT_CHUNK_SIZE)
+            os.chmod(path, 0o755 if member.mode & 0o111 else 0o644)
+
+            files += 1
+            size += member.size
+    finally:
+        archive.close()
+
+    return files, size
+
+def _collect_from_ant(params):
+    root = os.path.join(params['local_dir'], params['instance_id'])
+
+    try:
+        client = _get_connection(params)
+
+        started = time.time()
+
+        channel = client.get_transport().open_session()
+        channel.exec_command(_collect_command(params['remote_glob']))
+        channel.shutdown_write()
+
+        try:
+            files, size = _extract_stream(channel.makefile('rb'), root)
+        except tarfile.ReadError:
+            # An empty stream is not an archive, which is expected when nothing matched
+            files = size = 0
+
+        status = channel.recv_exit_status()
+        errors = channel.makefile_stderr('rb').read().decode('utf-8', 'replace')
+        channel.close()
+
+        _profile.record('download', params['instance_id'], started)
+    except (IOError, EOFError, paramiko.SSHException, tarfile.TarError) as e:
+        # Connection and archive errors only cost this ant's files, anything else is a bug
+        _log('Ant %i could not send its files: %s' % (params['i'], _error_text(e)))
+        return False
+
+    if status == COLLECT_NO_MATCH:
+        _log('Ant %i has no files matching %s.' % (params['i'], params['remote_glob']))
+        return True
+
+    # GNU tar exits with 1 when a file changed while it was being read, which is common for logs
+    if status > 1:
+        _print_lines('Ant %i (stderr): ' % params['i'], errors.splitlines())
+        _log('Ant %i could not send its files (exit code %i).' % (params['i'], status))
+        return False
+
+    _log('Ant %i sent %i files (%i bytes).' % (params['i'], files, size))
+
+    return True
+
+def collect(remote_glob, local_dir, parallel=DEFAULT_PARALLEL, profile_path=None, connect_timeout=DEFAULT_CONNECT_TIMEOUT, retries=DEFAULT_RETRIES):
+    """
+    Fetch the files matching remote_glob from every ant into local_dir/<instance id>/.
+
+    Each ant packs its files into a gzipped tar on the fly and the controller unpacks the
+    stream as it arrives, at most `parallel` ants at a time.
+    """
+    _profile.reset()
+
+    local_dir = os.path.abspath(local_dir)
+
+    ants = _assemble_ants(remote_glob=remote_glob, local_dir=local_dir, connect_timeout=connect_timeout, retries=retries)
+
+    if not ants:
+        print('No ants are ready to collect from.')
+        return
+
+    print('Collecting %s from %i ants into %s.' % (remote_glob, len(ants), local_dir))
+
+    pool = ThreadPool(max(1, min(int(parallel), len(ants))))
+
+    try:
+        collected = pool.map(_collect_from_ant, ants)
+    finally:
+        pool.close()
+        pool.join()
+        if not KEEP_CONNECTIONS:
+            _close_connections()
+
+    _profile.summary()
+    if profile_path:
+        _profile.write_trace(profile_path)
+
+    failed = collected.count(False)
+    if failed:
+        print('%i of %i ants could not send their files.' % (failed, len(ants)))
+
+    print('The hive has delivered.')
 
-    sys.exit(0)
+    sys.exit(1 if failed else 0)
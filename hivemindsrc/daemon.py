@@ -0,0 +1,196 @@
+#!/bin/env python
+
+"""
+The MIT License
+
+Copyright (c) 2010 The Chicago Tribune & Contributors
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import json
+import os
+import socket
+import sys
+import threading
+
+SOCKET_FILENAME = os.path.expanduser('~/.ants.sock')
+
+# The client side of the daemon only needs the standard library, so forwarding a command
+# costs neither the boto and paramiko imports nor any connection setup.
+
+def forward(argv):
+    """
+    Run a command on the hive daemon, if one is listening.
+
+    Returns the exit status of the command, or None when there is no daemon to forward to.
+    """
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(SOCKET_FILENAME):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(SOCKET_FILENAME)
+    except socket.error:
+        # A socket file without a daemon behind it is left over from one that died
+        sock.close()
+        return None
+
+    try:
+        sock.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd()}).encode('utf-8') + b'\n')
+
+        for line in sock.makefile('rb'):
+            message = json.loads(line.decode('utf-8'))
+
+            if 'exit' in message:
+                return message['exit']
+
+            sys.stdout.write(message['out'])
+            sys.stdout.flush()
+    finally:
+        sock.close()
+
+    print('The hive daemon went away before the command finished.')
+    return 1
+
+def stop():
+    if forward(['daemon', 'stop']) is None:
+        print('No hive daemon is running.')
+
+class _SocketWriter(object):
+    """
+    A stdout replacement that sends everything written to it to the forwarding client.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def write(self, text):
+        with self.lock:
+            if self.closed:
+                return
+
+            try:
+                self.sock.sendall(json.dumps({'out': text}).encode('utf-8') + b'\n')
+            except socket.error:
+                # The client has gone, carry on without its output
+                self.closed = True
+
+    def flush(self):
+        pass
+
+    def finish(self, status):
+        self.write_message({'exit': status})
+
+    def write_message(self, message):
+        with self.lock:
+            if not self.closed:
+                try:
+                    self.sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+                except socket.error:
+                    self.closed = True
+
+def _exit_status(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+
+    print(code)
+    return 1
+
+def _handle(sock):
+    from . import main
+
+    request = json.loads(sock.makefile('rb').readline().decode('utf-8'))
+    argv = request['argv']
+    writer = _SocketWriter(sock)
+
+    if argv == ['daemon', 'ping']:
+        writer.finish(0)
+        return True
+
+    if argv == ['daemon', 'stop']:
+        writer.write('The hive daemon is shutting down.\n')
+        writer.finish(0)
+        return False
+
+    save_stdout, save_stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = writer
+
+    try:
+        os.chdir(request['cwd'])
+        main.parse_options(argv)
+        status = 0
+    except SystemExit as e:
+        status = _exit_status(e.code)
+    except Exception as e:
+        print('The hive daemon could not run the command: %s' % e)
+        status = 1
+    finally:
+        sys.stdout, sys.stderr = save_stdout, save_stderr
+
+    writer.finish(status)
+    return True
+
+def serve():
+    """
+    Keep the hive warm and run forwarded commands until told to stop.
+
+    Commands are run one at a time. SSH transports and EC2 connections stay open between
+    commands, so repeated orders skip the imports, describe calls and handshakes.
+    """
+    from . import ants
+
+    ants.KEEP_CONNECTIONS = True
+
+    if os.path.exists(SOCKET_FILENAME):
+        if forward(['daemon', 'ping']) is not None:
+            print('A hive daemon is already listening on %s.' % SOCKET_FILENAME)
+            return
+        os.remove(SOCKET_FILENAME)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+        server.bind(SOCKET_FILENAME)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+
+    print('The hive daemon is listening on %s.' % SOCKET_FILENAME)
+
+    try:
+        running = True
+        while running:
+            sock, address = server.accept()
+            try:
+                running = _handle(sock)
+            except (socket.error, ValueError) as e:
+                print('Dropped a request: %s' % e)
+            finally:
+                sock.close()
+    finally:
+        server.close()
+        os.remove(SOCKET_FILENAME)
+        ants._close_connections()
+
+    print('The hive daemon has stopped.')
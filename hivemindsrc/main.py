@@ -24,13 +24,18 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-from . import ants
+from . import daemon
 from optparse import OptionParser, OptionGroup
+import os
+import sys
 
-def parse_options():
+def parse_options(argv=None):
     """
     Handle the command line arguments for spinning up bees
     """
+    # Imported here so commands forwarded to the daemon never pay for boto and paramiko
+    from . import ants
+
     parser = OptionParser(usage="""
 bees COMMAND [options]
 
@@ -42,9 +47,18 @@ commands:
   up      Start a batch of load testing servers.
   order  Begin the attack on a specific url.
   down    Shutdown and deactivate the load testing servers.
+  scale N Grow or shrink the hive to N servers, in the zones and with the settings it was brought up with.
   report  Report the status of the load testing servers.
+  collect REMOTE_GLOB LOCAL_DIR
+          Fetch the files matching REMOTE_GLOB from every ant into LOCAL_DIR/<instance id>/.
+  daemon  Keep the hive connected and serve the other commands from a local socket
+          ("daemon stop" shuts it down).
     """)
 
+    parser.add_option('--profile', metavar="PROFILE", nargs=1,
+                      action='store', dest='profile', type='string', default=None,
+                      help="Write a trace of every phase on every ant to this file, for chrome://tracing or Perfetto (up, scale, order and collect).")
+
     up_group = OptionGroup(parser, "up",
                            """In order to spin up new servers you will need to specify at least the -k command, which is the name of the EC2 keypair to use for creating and connecting to the new servers. The ants will expect to find a .pem file with this name in ~/.ssh/. Alternatively, ants can use SSH Agent for the key.""")
 
@@ -61,10 +75,10 @@ commands:
                         help="The security group(s) to run the instances under (default: default).")
     up_group.add_option('-z', '--zone',  metavar="ZONE",  nargs=1,
                         action='store', dest='zone', type='string', default='us-east-1d',
-                        help="The availability zone to start the instances in (default: us-east-1d).")
+                        help="The availability zone to start the instances in (default: us-east-1d). Several zones, in any regions, can be given with a count each, e.g. us-east-1a:10,eu-west-1b:20. Zones without a count share the servers from -s evenly.")
     up_group.add_option('-i', '--instance',  metavar="INSTANCE",  nargs=1,
                         action='store', dest='instance', type='string', default='ami-ff17fb96',
-                        help="The instance-id to use for each server from (default: ami-ff17fb96).")
+                        help="The instance-id to use for each server from (default: ami-ff17fb96). When -z spans several regions, give one per region, e.g. us-east-1=ami-a,eu-west-1=ami-b.")
     up_group.add_option('-t', '--type',  metavar="TYPE",  nargs=1,
                         action='store', dest='type', type='string', default='t1.micro',
                         help="The instance-type to use for each server (default: t1.micro).")
@@ -77,6 +91,14 @@ commands:
     up_group.add_option('-b', '--bid', metavar="BID", nargs=1,
                         action='store', dest='bid', type='float', default=None,
                         help="The maximum bid price per spot instance (default: None).")
+    up_group.add_option('--min-fulfilled', metavar="MIN_FULFILLED", nargs=1,
+                        action='store', dest='min_fulfilled', type='int', default=None,
+                        help="Stop waiting for spot ants once the hive has this many ants, counting the ones already running or started from the warm pool, and cancel the rest. The spot ants still needed are shared out over the zones in proportion to their requests (default: all).")
+    up_group.add_option('--spot-timeout', metavar="SECONDS", nargs=1,
+                        action='store', dest='spot_timeout', type='int', default=None,
+                        help="Stop waiting for spot ants after this many seconds, even if fewer than --min-fulfilled have arrived, keep the ones that have and cancel the rest (default: None).")
+    up_group.add_option('-w', '--wait-ssh', action='store_true', dest='wait_ssh', default=False,
+                        help="Wait until every ant accepts SSH connections before returning (also for scale).")
 
     parser.add_option_group(up_group)
 
@@ -90,10 +112,82 @@ commands:
     order_group.add_option('-f', '--file', metavar="FILE", nargs=1,
                             action='append', dest='files', type='string',
                             help="File with orders")
+    order_group.add_option('--sync', metavar="DIR", nargs=1,
+                            action='store', dest='sync', type='string', default=None,
+                            help="Sync this directory to /tmp/<name of DIR>/ on every ant before the orders run. Only files and blocks that changed since the last sync are sent.")
+    order_group.add_option('-p', '--parallel', metavar="PARALLEL", nargs=1,
+                            action='store', dest='parallel', type='int', default=ants.DEFAULT_PARALLEL,
+                            help="The maximum number of ants to work with at the same time, also for collect (default: %d)." % ants.DEFAULT_PARALLEL)
+    order_group.add_option('--tree-fanout', metavar="FANOUT", nargs=1,
+                            action='store', dest='fanout', type='int', default=0,
+                            help="Upload order files to this many ants only and let every ant that has a copy pass it on to this many more over the private network (default: 0, upload to every ant directly). The ants' security group must allow SSH between them.")
+    order_group.add_option('-r', '--results', metavar="RESULTS", nargs=1,
+                            action='store', dest='results', type='string', default=None,
+                            help="Write the result of every order on every ant to this file, as CSV if it ends in .csv and JSON lines otherwise.")
+    order_group.add_option('--input', metavar="INPUT", nargs=1,
+                            action='store', dest='input', type='string', default=None,
+                            help="Split this file into chunks of lines and hand them out to ants as they become free. Each chunk replaces {input} in the order, or is piped to the order on stdin when there is no placeholder.")
+    order_group.add_option('--chunk-size', metavar="LINES", nargs=1,
+                            action='store', dest='chunk_size', type='int', default=ants.DEFAULT_CHUNK_SIZE,
+                            help="The number of input lines in each chunk (default: %d)." % ants.DEFAULT_CHUNK_SIZE)
+    order_group.add_option('--connect-timeout', metavar="SECONDS", nargs=1,
+                            action='store', dest='connect_timeout', type='float', default=ants.DEFAULT_CONNECT_TIMEOUT,
+                            help="Give up on connecting to an ant after this many seconds, also for collect and report --probe (default: %d)." % ants.DEFAULT_CONNECT_TIMEOUT)
+    order_group.add_option('--order-timeout', metavar="SECONDS", nargs=1,
+                            action='store', dest='order_timeout', type='float', default=None,
+                            help="Give up on an order that has run for this many seconds (default: None).")
+    order_group.add_option('--retries', metavar="RETRIES", nargs=1,
+                            action='store', dest='retries', type='int', default=ants.DEFAULT_RETRIES,
+                            help="Retry failed connections, also for collect and report --probe, and failed or timed out chunks of --input, this many times (default: %d)." % ants.DEFAULT_RETRIES)
+    order_group.add_option('--hedge', metavar="FACTOR", nargs=1,
+                            action='store', dest='hedge', type='float', default=0,
+                            help="With --input, start a second copy of a chunk on an idle ant once it has run FACTOR times longer than the p95 of finished chunks, and keep whichever finishes first (default: off).")
+    order_group.add_option('--per-ant-concurrency', metavar="K", nargs=1,
+                            action='store', dest='concurrency', type='string', default=None,
+                            help="Run K copies of each order on every ant at once, or K workers taking --input chunks, each told its index in $HIVEMIND_WORKER (0 to K-1) and K in $HIVEMIND_WORKERS. \"auto\" uses the number of cores on each ant (default: 1).")
+    order_group.add_option('--max-load', metavar="LOAD", nargs=1,
+                            action='store', dest='max_load', type='float', default=None,
+                            help="Skip ants whose load average per core was above LOAD, or that could not be reached, at the last report --probe. Ants without a recent probe are used.")
+    order_group.add_option('--weighted', action='store_true', dest='weighted', default=False,
+                            help="Size each ant's share by the cores it had to spare at the last report --probe: one worker per spare core with --per-ant-concurrency auto, and otherwise --input chunks that grow with the spare cores.")
+    order_group.add_option('--aggregate', action='store_const', const='output', dest='aggregate', default=None,
+                            help="Instead of printing every ant's output as it arrives, group identical outputs once the order is done and print each distinct output once, with the number of ants and which ones.")
+    order_group.add_option('--aggregate-diff', action='store_const', const='diff', dest='aggregate',
+                            help="Like --aggregate, but print only the most common output in full and every other one as a diff against it.")
+    order_group.add_option('--rate', metavar="RATE", nargs=1,
+                            action='store', dest='rate', type='string', default=None,
+                            help="Start ants at this rate instead of all at once, e.g. 20/s or 300/m (default: all at once).")
+    order_group.add_option('--ramp', metavar="SECONDS", nargs=1,
+                            action='store', dest='ramp', type='float', default=None,
+                            help="Spread the ant starts evenly over this many seconds, or with --rate, raise the rate linearly from zero to RATE over them.")
+    order_group.add_option('--stages', metavar="STAGES", nargs=1,
+                            action='store', dest='stages', type='string', default=None,
+                            help="Start ants in steps, given as COUNT@SECONDS pairs, e.g. 10@0,50@30,200@60 starts 10 ants at once, 50 in total after 30s and 200 after 60s. The last stage also starts every ant beyond its COUNT.")
+    order_group.add_option('--max-active', metavar="ANTS", nargs=1,
+                            action='store', dest='max_active', type='int', default=None,
+                            help="Keep at most this many ants working at once, starting the next one as soon as one finishes (default: --parallel).")
+    order_group.add_option('--pipeline', action='store_true', dest='pipeline', default=False,
+                            help="Let each ant run all of its orders and files on its own without waiting for the rest of the hive.")
+    order_group.add_option('--lockstep', action='store_false', dest='pipeline',
+                            help="Wait for every ant to finish each order before starting the next one (default).")
 
     parser.add_option_group(order_group)
 
-    (options, args) = parser.parse_args()
+    report_group = OptionGroup(parser, "report")
+
+    report_group.add_option('--probe', action='store_true', dest='probe', default=False,
+                            help="Also measure the cores, load average, available memory and SSH round trip time of every running ant, and keep them for order --max-load and --weighted.")
+
+    parser.add_option_group(report_group)
+
+    down_group = OptionGroup(parser, "down")
+
+    down_group.add_option('--keep-warm', action='store_true', dest='keep_warm', default=False,
+                          help="Stop the ants instead of terminating them. The next up starts them again before launching any new ones. Stopped ants cost nothing but their disks.")
+
+    parser.add_option_group(down_group)
+
+    (options, args) = parser.parse_args(argv)
 
     if len(args) <= 0:
         parser.error('Please enter a command.')
@@ -104,20 +198,73 @@ commands:
         if not options.key:
             parser.error('To spin up new instances you need to specify a key-pair name with -k')
 
+        if options.subnet and ',' in options.zone:
+            parser.error('A subnet belongs to a single zone, so -v cannot be used with several zones')
+
         if options.group == 'default':
             print('New ants will use the "default" EC2 security group. Please note that port 22 (SSH) is not normally open on this group. You will need to use to the EC2 tools to open it before you will be able to attack.')
 
-        ants.up(options.servers, options.group, options.zone, options.instance, options.type, options.login, options.key, options.subnet, options.bid)
+        ants.up(options.servers, options.group, options.zone, options.instance, options.type, options.login, options.key, options.subnet, options.bid, options.wait_ssh, options.min_fulfilled, options.spot_timeout, options.profile)
     elif command == 'order':
-        if not options.orders and not options.files:
+        if not options.orders and not options.files and not options.sync:
             parser.error('Need orders')
 
-        ants.order(options.orders, options.files)
+        if options.sync and not os.path.isdir(options.sync):
+            parser.error('--sync needs a directory')
+
+        if options.parallel < 1:
+            parser.error('--parallel must be at least 1')
+
+        if options.input and not options.orders:
+            parser.error('--input needs an order to run on every chunk')
 
+        if options.chunk_size < 1:
+            parser.error('--chunk-size must be at least 1')
+
+        if options.max_active is not None and options.max_active < 1:
+            parser.error('--max-active must be at least 1')
+
+        if options.concurrency is not None and options.concurrency != 'auto' and (not options.concurrency.isdigit() or int(options.concurrency) < 1):
+            parser.error('--per-ant-concurrency must be a number of workers or auto')
+
+        if options.ramp is not None and options.ramp <= 0:
+            parser.error('--ramp must be more than 0 seconds')
+
+        ants.order(options.orders, options.files, options.parallel, options.pipeline, options.fanout, options.results, options.profile, options.input, options.chunk_size,
+                   options.connect_timeout, options.order_timeout, options.retries, options.hedge, options.sync,
+                   options.rate, options.ramp, options.stages, options.max_active, options.concurrency,
+                   options.max_load, options.weighted, options.aggregate)
+
+    elif command == 'scale':
+        if len(args) != 2 or not args[1].isdigit():
+            parser.error('scale needs the number of ants the hive should have')
+
+        ants.scale(int(args[1]), options.wait_ssh, options.profile)
     elif command == 'down':
-        ants.down()
+        ants.down(options.keep_warm)
     elif command == 'report':
-        ants.report()
+        ants.report(options.probe, options.parallel, options.connect_timeout, options.retries)
+    elif command == 'collect':
+        if len(args) != 3:
+            parser.error('collect needs a remote glob and a local directory')
+
+        if options.parallel < 1:
+            parser.error('--parallel must be at least 1')
+
+        ants.collect(args[1], args[2], options.parallel, options.profile, options.connect_timeout, options.retries)
+    elif command == 'daemon':
+        if args[1:] == ['stop']:
+            daemon.stop()
+        else:
+            daemon.serve()
 
 def main():
-    parse_options()
+    argv = sys.argv[1:]
+
+    # Hand the command to a running daemon, which already has the hive connected
+    if argv and argv[0] != 'daemon':
+        status = daemon.forward(argv)
+        if status is not None:
+            sys.exit(status)
+
+    parse_options(argv)